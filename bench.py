@@ -0,0 +1,388 @@
+# bench.py - нагрузочный тест бота без сети
+#
+# Обработчики bot.py вызываются с синтетическими Update, Bot API заменён
+# локальным HTTP-сервером, а yt-dlp - фейковым экстрактором, который отдаёт
+# заготовленные метаданные и локальный аудиофайл. Нужны только зависимости
+# из requirements.txt; интернет не нужен.
+#
+#   python bench.py                       # все сценарии
+#   python bench.py --scenario inline_storm --users 50
+#   python bench.py --json results.json
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+TOKEN = '123456:BENCH'
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+QUERIES = [
+    'imagine dragons believer', 'shape of you', 'bohemian rhapsody', 'blinding lights',
+    'levitating', 'du hast', 'dancing queen', 'smells like teen spirit',
+]
+
+# === ЗАГЛУШКА BOT API ===
+class StubBotAPI(BaseHTTPRequestHandler):
+    """Отвечает на методы Bot API заготовками, считает вызовы"""
+    calls = {}
+    lock = threading.Lock()
+    message_ids = itertools.count(1000)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = self.rfile.read(length)
+        method = self.path.rsplit('/', 1)[-1]
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'sendMediaGroup':
+            # По альбому - сообщение на каждый трек
+            count = len(re.findall(rb'%22type%22%3A\+?%22audio%22|"type":\s*"audio"', request))
+            result = [self._result('sendAudio') for _ in range(count)]
+        else:
+            result = self._result(method)
+        body = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _result(self, method):
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('sendMessage', 'sendAudio'):
+            message = {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': -100, 'type': 'group', 'title': 'bench'},
+                'from': BOT_USER,
+            }
+            if method == 'sendAudio':
+                file_id = f'AUDIO{message["message_id"]}'
+                message['audio'] = {'file_id': file_id, 'file_unique_id': file_id, 'duration': 30}
+            return message
+        return True
+
+    def log_message(self, *args):
+        pass
+
+def start_stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubBotAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# === ФЕЙКОВЫЙ YT-DLP ===
+def make_fixture(path, seconds):
+    """Синусоида в AAC - remux в convert_audio отработает как на реальном треке"""
+    import imageio_ffmpeg
+    subprocess.run(
+        [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error',
+         '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+         '-c:a', 'aac', '-b:a', '128k', path],
+        check=True
+    )
+
+def make_fake_ydl(fixture, search_latency, download_latency):
+    class FakeYoutubeDL:
+        """Минимальный интерфейс yt_dlp.YoutubeDL, который использует bot.py"""
+
+        def __init__(self, opts=None):
+            self.opts = opts or {}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def extract_info(self, url, download=False, process=True):
+            if 'list=' in url:
+                time.sleep(search_latency)
+                count = int(url.rsplit('size=', 1)[-1])
+                return {'title': 'Bench playlist', 'entries': [self._entry(f'{url}-{i}') for i in range(count)]}
+            if url.startswith('ytsearch'):
+                time.sleep(search_latency)
+                count, _, query = url[len('ytsearch'):].partition(':')
+                return {'entries': [self._entry(f'{query}-{i}') for i in range(int(count or 1))]}
+            video_id = url.rsplit('=', 1)[-1]
+            info = self._entry(video_id)
+            info.update(acodec='mp4a.40.2', format_id='140', ext='m4a')
+            return self.process_ie_result(info, download) if process else info
+
+        def process_ie_result(self, info, download=True):
+            if download:
+                time.sleep(download_latency)
+                for hook in self.opts.get('progress_hooks', []):
+                    hook({'status': 'downloading'})
+                path = self.prepare_filename(info)
+                shutil.copyfile(fixture, path)
+                info['requested_downloads'] = [{'filepath': path}]
+            return info
+
+        def prepare_filename(self, info):
+            return self.opts['outtmpl'].replace('%(format_id)s', info['format_id']).replace('%(ext)s', info['ext'])
+
+        @staticmethod
+        def _entry(key):
+            video_id = ('v' + str(abs(hash(key)) % 10 ** 10)).ljust(11, '0')[:11]
+            return {
+                'id': video_id,
+                'title': f'Artist {key[:12]} - Song {key[-6:]} (Official Video)',
+                'uploader': 'Artist - Topic',
+                'duration': 30,
+                'thumbnail': None,
+            }
+
+    return FakeYoutubeDL
+
+# === СИНТЕТИЧЕСКИЕ UPDATE ===
+_update_ids = itertools.count(1)
+
+def user_dict(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+def inline_update(user_id, query):
+    return {'update_id': next(_update_ids), 'inline_query': {
+        'id': str(next(_update_ids)), 'from': user_dict(user_id), 'query': query, 'offset': '',
+    }}
+
+def command_update(user_id, chat_id, text):
+    command = text.split()[0]
+    return {'update_id': next(_update_ids), 'message': {
+        'message_id': next(_update_ids), 'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'group', 'title': 'bench'},
+        'from': user_dict(user_id), 'text': text,
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+    }}
+
+def callback_update(user_id, chat_id, video_id):
+    return {'update_id': next(_update_ids), 'callback_query': {
+        'id': str(next(_update_ids)), 'from': user_dict(user_id), 'chat_instance': 'bench',
+        'data': f'dl_{video_id}',
+        'message': {
+            'message_id': next(_update_ids), 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group', 'title': 'bench'},
+            'from': BOT_USER, 'text': '🎵 track',
+        },
+    }}
+
+# === ИЗМЕРЕНИЯ ===
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # Nearest-rank: наименьшее значение, не меньше которого p% выборки
+    index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+async def measure(name, jobs):
+    """Запускает корутины-задания параллельно; каждая возвращает свою задержку"""
+    cpu_before = cpu_seconds()
+    started = time.perf_counter()
+    latencies = [lat for lat in await asyncio.gather(*jobs) if lat is not None]
+    elapsed = time.perf_counter() - started
+    return {
+        'scenario': name,
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'cpu_s': cpu_seconds() - cpu_before,
+        'rss_mb': rss_mb(),
+    }
+
+# === СЦЕНАРИИ ===
+# update_id -> задачи spawn_job этого апдейта: задержка меряется до их конца
+SPAWNED = {}
+
+def track_spawned_jobs(bot):
+    spawn_job = bot.spawn_job
+
+    def tracked(context, coroutine, update=None):
+        task = spawn_job(context, coroutine, update)
+        if update is not None:
+            SPAWNED.setdefault(update.update_id, []).append(task)
+        return task
+    bot.spawn_job = tracked
+
+async def run_update(app, data):
+    """Апдейт идёт тем же путём, что из getUpdates/webhook: процессор апдейтов
+    (CONCURRENT_UPDATES, ChatOrderedUpdateProcessor) и обработчики Application"""
+    from telegram import Update
+    update = Update.de_json(data, app.bot)
+    started = time.perf_counter()
+    await app.update_processor.process_update(update, app.process_update(update))
+    await asyncio.gather(*SPAWNED.pop(update.update_id, []), return_exceptions=True)
+    return time.perf_counter() - started
+
+async def inline_storm(bot, app, args):
+    """Пользователи набирают запросы по символу; меряется ответ на последний"""
+    async def type_query(user_id, query):
+        tasks = []
+        for i in range(1, len(query) + 1):
+            tasks.append(asyncio.create_task(
+                run_update(app, inline_update(user_id, query[:i]))
+            ))
+            await asyncio.sleep(args.keystroke_delay)
+        latencies = await asyncio.gather(*tasks)
+        return latencies[-1]
+
+    rng = random.Random(1)
+    jobs = [type_query(10_000 + u, rng.choice(QUERIES)) for u in range(args.users)]
+    return await measure('inline_storm', jobs)
+
+def burst_requests(args):
+    rng = random.Random(2)
+    videos = [make_video_id(i) for i in range(args.distinct_tracks)]
+    return [(20_000 + u, rng.choice(videos)) for u in range(args.users)]
+
+def make_video_id(i):
+    return f'burst{i:06d}'
+
+async def group_download_burst(bot, app, args):
+    """Все пользователи группы почти одновременно жмут кнопки скачивания"""
+    jobs = [
+        run_update(app, callback_update(user_id, -100, video_id))
+        for user_id, video_id in burst_requests(args)
+    ]
+    return await measure('group_download_burst', jobs)
+
+async def cache_hit_replay(bot, app, args):
+    """Тот же всплеск повторно - все треки уже есть в TRACK_CACHE"""
+    jobs = [
+        run_update(app, callback_update(user_id, -100, video_id))
+        for user_id, video_id in burst_requests(args)
+    ]
+    return await measure('cache_hit_replay', jobs)
+
+async def playlist_batch(bot, app, args):
+    """Один популярный плейлист в нескольких чатах сразу; меряется отправка
+    всего плейлиста. Общие треки должны скачиваться один раз.
+    """
+    jobs = []
+    url = f'https://www.youtube.com/playlist?list=bench&size={args.playlist_size}'
+    for n in range(args.playlists):
+        data = command_update(30_000 + n, -200 - n, f'/playlist {url}')
+        jobs.append(run_update(app, data))
+    return await measure('playlist_batch', jobs)
+
+SCENARIOS = {
+    'inline_storm': inline_storm,
+    'group_download_burst': group_download_burst,
+    'cache_hit_replay': cache_hit_replay,
+    'playlist_batch': playlist_batch,
+}
+
+def print_report(results):
+    header = f"{'scenario':<22}{'reqs':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}{'cpu s':>8}{'rss MB':>9}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['scenario']:<22}{r['requests']:>6}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}"
+              f"{r['p99_ms']:>10.1f}{r['throughput_rps']:>9.1f}{r['cpu_s']:>8.2f}{r['rss_mb']:>9.1f}")
+
+async def run(args, workdir):
+    server = start_stub_server()
+    fixture = args.fixture or os.path.join(workdir, 'fixture.m4a')
+    if not args.fixture:
+        make_fixture(fixture, args.track_seconds)
+
+    sys.path.insert(0, REPO_DIR)
+    import bot
+    import yt_dlp
+    yt_dlp.YoutubeDL = make_fake_ydl(fixture, args.search_latency, args.download_latency)
+
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    app = bot.build_application(TOKEN, base_url=f'{base}/bot', base_file_url=f'{base}/file/bot')
+    bot.register_handlers(app)
+    track_spawned_jobs(bot)
+    await app.initialize()
+    await app.start()
+    await bot.on_startup(app)
+
+    names = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+    results = []
+    try:
+        for name in names:
+            results.append(await SCENARIOS[name](bot, app, args))
+    finally:
+        await bot.on_shutdown(app)
+        await app.stop()
+        await app.shutdown()
+        server.shutdown()
+
+    print_report(results)
+    print(f"\nBot API calls: {dict(sorted(StubBotAPI.calls.items()))}")
+    print(f"Search cache: {bot.SEARCH_CACHE.hits} hits / {bot.SEARCH_CACHE.misses} misses, "
+          f"audio paths: {dict(bot.AUDIO_PATH_STATS)}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test for bot.py')
+    parser.add_argument('--scenario', default='all', choices=['all', *SCENARIOS])
+    parser.add_argument('--users', type=int, default=30)
+    parser.add_argument('--distinct-tracks', type=int, default=5)
+    parser.add_argument('--playlists', type=int, default=3)
+    parser.add_argument('--playlist-size', type=int, default=12)
+    parser.add_argument('--keystroke-delay', type=float, default=0.08)
+    parser.add_argument('--search-latency', type=float, default=0.3, help='fake extractor search time, s')
+    parser.add_argument('--download-latency', type=float, default=1.0, help='fake extractor download time, s')
+    parser.add_argument('--track-seconds', type=int, default=180, help='length of the generated fixture')
+    parser.add_argument('--fixture', help='use this audio file instead of a generated one')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+
+    if args.fixture:
+        args.fixture = os.path.abspath(args.fixture)
+    workdir = tempfile.mkdtemp(prefix='musicbot-bench-')
+    # bot.py пишет кэши и temp_audio в текущий каталог - изолируем их
+    os.chdir(workdir)
+    os.environ['BOT_TOKEN'] = TOKEN
+    os.environ['DB_FILE'] = os.path.join(workdir, 'bench.db')
+    os.environ.setdefault('INLINE_DEBOUNCE', '0.3')
+    os.environ.setdefault('RATE_LIMIT_TRACKS', str(10 ** 6))
+    # Лимит Bot API мерил бы сам себя, а не бота
+    os.environ.setdefault('TG_OVERALL_RATE', '0')
+    # Заглушка API - обычный HTTP/1.1 без TLS
+    os.environ['TG_HTTP_VERSION'] = '1.1'
+    # Фейковый yt-dlp подменяется только в этом процессе
+    os.environ['WORKER_BACKEND'] = 'thread'
+    try:
+        asyncio.run(run(args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
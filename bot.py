@@ -1,18 +1,36 @@
 # bot.py - Улучшенный Telegram Music Bot
+import time
+BOOT_STARTED = time.perf_counter()
+
+import asyncio
+import atexit
 import logging
 import os
-import imageio_ffmpeg
 import re
+import shlex
+import subprocess
 import traceback
-import requests
+import base64
+import bisect
+import contextlib
+import copy
+import functools
+import inspect
 import json
+import multiprocessing
+import sqlite3
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
-from PIL import Image
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InlineQueryResultCachedAudio, InputTextMessageContent
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler, filters, ContextTypes
-import yt_dlp
-from mutagen.mp4 import MP4, MP4Cover
-from mutagen.oggvorbis import OggVorbis
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InlineQueryResultCachedAudio, InlineQueryResultsButton, InputMediaAudio, InputTextMessageContent
+from telegram.ext import AIORateLimiter, Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler, ExtBot, filters, ContextTypes
+from telegram.request import HTTPXRequest
+from titles import parse_artist_title, parse_many
+# yt_dlp, PIL, mutagen, httpx и imageio_ffmpeg импортируются там, где
+# нужны: старт не ждёт их загрузки, а warm_up подгружает их в фоне
 
 # Настройка логирования
 logging.basicConfig(
@@ -26,86 +44,1003 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 TEMP_DIR = 'temp_audio'
 CACHE_FILE = 'track_cache.json'
 
+# В процессах-воркерах (WORKER_BACKEND=process) модуль только скачивает и
+# готовит файлы: кэшами и состоянием пользователей владеет главный процесс
+IS_WORKER = multiprocessing.parent_process() is not None
+
 if not os.path.exists(TEMP_DIR):
     os.makedirs(TEMP_DIR)
 
-# Загрузка кэша из файла
-def load_cache():
-    if os.path.exists(CACHE_FILE):
+# === МЕТРИКИ ===
+# Счётчики и гистограммы стадий в формате Prometheus. Выключенные метрики
+# почти ничего не стоят: stage() отдаёт общий пустой контекст, а timed()
+# возвращает функцию без обёртки
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 - без HTTP /metrics
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_ENABLED = METRICS_PORT > 0 or os.getenv('METRICS', '0') == '1'
+METRICS_PREFIX = 'musicbot_'
+# Границы бакетов гистограмм, секунды
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_NO_STAGE = contextlib.nullcontext()
+
+class _StageTimer:
+    """Замер одной стадии; исключение считается ошибкой стадии"""
+    __slots__ = ('metrics', 'stage', 'started')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe('stage_seconds', time.perf_counter() - self.started, stage=self.stage)
+        # Отмена задачи (CancelledError) - не ошибка
+        if exc_type is not None and issubclass(exc_type, Exception):
+            self.metrics.inc('errors_total', stage=self.stage, type=exc_type.__name__)
+        return False
+
+class Metrics:
+    """Реестр метрик. Счётчики и гистограммы копятся здесь, текущие
+    значения (очереди, размеры кэшей) снимают коллекторы при отдаче /metrics.
+    """
+
+    HELP = {
+        'stage_seconds': 'Time spent in a processing stage',
+        'errors_total': 'Errors by stage and exception type',
+        'track_cache_requests_total': 'TRACK_CACHE lookups on download requests',
+        'uploaded_bytes_total': 'Audio bytes uploaded to Telegram',
+        'search_cache_requests_total': 'Search cache lookups',
+        'pool_running': 'Jobs running in a pool',
+        'pool_queued': 'Jobs waiting in a pool queue',
+        'inflight_downloads': 'Downloads other requests can join',
+        'tracks_cached': 'Tracks known to TRACK_CACHE',
+        'audio_cache_bytes': 'Size of the local audio cache',
+        'audio_cache_events_total': 'Local audio cache events',
+        'audio_path_total': 'Prepared tracks by ffmpeg path',
+        'prefetch_events_total': 'Prefetch events',
+    }
+
+    def __init__(self, enabled, buckets=STAGE_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}    # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> [счётчики бакетов..., +Inf, сумма]
+        self._collectors = []
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            hist[bisect.bisect_left(self.buckets, value)] += 1
+            hist[-1] += value
+
+    def stage(self, name):
+        """Контекстный менеджер замера стадии"""
+        if not self.enabled:
+            return _NO_STAGE
+        return _StageTimer(self, name)
+
+    def timed(self, name):
+        """Декоратор замера стадии для обычных и async функций"""
+        def decorate(fn):
+            if not self.enabled:
+                return fn
+            if inspect.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    with _StageTimer(self, name):
+                        return await fn(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with _StageTimer(self, name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def drain(self):
+        """Забирает накопленные счётчики и гистограммы, обнуляя их"""
+        with self._lock:
+            snapshot = (self._counters, self._histograms)
+            self._counters, self._histograms = {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """Добавляет значения, собранные в процессе-воркере"""
+        if not self.enabled or not snapshot:
+            return
+        counters, histograms = snapshot
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, hist in histograms.items():
+                own = self._histograms.get(key)
+                if own is None:
+                    self._histograms[key] = hist
+                else:
+                    self._histograms[key] = [a + b for a, b in zip(own, hist)]
+
+    def collector(self, fn):
+        """fn() отдаёт кортежи (имя, тип, значение, метки) на момент запроса"""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        """Текстовый формат Prometheus"""
+        families = {}  # имя -> (тип, строки)
+
+        def family(name, kind):
+            return families.setdefault(name, (kind, []))[1]
+
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [(key, list(hist)) for key, hist in self._histograms.items()]
+        for (name, labels), value in counters:
+            family(name, 'counter').append(self._sample(name, labels, value))
+        for (name, labels), hist in histograms:
+            lines = family(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), hist):
+                cumulative += count
+                lines.append(self._sample(f'{name}_bucket', labels + (('le', bound),), cumulative))
+            lines.append(self._sample(f'{name}_sum', labels, hist[-1]))
+            lines.append(self._sample(f'{name}_count', labels, cumulative))
+        for collect in self._collectors:
+            try:
+                for name, kind, value, labels in collect():
+                    family(name, kind).append(self._sample(name, tuple(labels.items()), value))
+            except Exception as e:
+                logger.error(f"Metrics collector error: {e}")
+
+        out = []
+        for name, (kind, lines) in families.items():
+            out.append(f'# HELP {METRICS_PREFIX}{name} {self.HELP.get(name, name)}')
+            out.append(f'# TYPE {METRICS_PREFIX}{name} {kind}')
+            out.extend(lines)
+        return '\n'.join(out) + '\n'
+
+    @staticmethod
+    def _sample(name, labels, value):
+        if labels:
+            pairs = ','.join(f'{key}="{Metrics._escape(val)}"' for key, val in labels)
+            return f'{METRICS_PREFIX}{name}{{{pairs}}} {value}'
+        return f'{METRICS_PREFIX}{name} {value}'
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+METRICS = Metrics(METRICS_ENABLED)
+
+@METRICS.collector
+def runtime_metrics():
+    """Текущее состояние пулов и кэшей; объекты создаются ниже в модуле"""
+    for pool in (SEARCH_POOL.slots, DOWNLOAD_POOL.slots, UPLOAD_SLOTS):
+        yield 'pool_running', 'gauge', pool.running, {'pool': pool.name}
+        yield 'pool_queued', 'gauge', pool.queued, {'pool': pool.name}
+    yield 'inflight_downloads', 'gauge', len(INFLIGHT_DOWNLOADS), {}
+    yield 'tracks_cached', 'gauge', len(TRACK_CACHE), {}
+    yield 'search_cache_requests_total', 'counter', SEARCH_CACHE.hits, {'result': 'hit'}
+    yield 'search_cache_requests_total', 'counter', SEARCH_CACHE.misses, {'result': 'miss'}
+    yield 'audio_cache_bytes', 'gauge', AUDIO_CACHE.total_bytes, {}
+    for event, count in dict(AUDIO_CACHE.stats).items():
+        yield 'audio_cache_events_total', 'counter', count, {'event': event}
+    for path, count in dict(AUDIO_PATH_STATS).items():
+        yield 'audio_path_total', 'counter', count, {'path': path}
+    for event, count in dict(PREFETCHER.stats).items():
+        yield 'prefetch_events_total', 'counter', count, {'event': event}
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_metrics_server(port, host=METRICS_HOST):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Metrics: http://{host}:{port}/metrics")
+    return server
+
+# === КЭШ ТРЕКОВ ===
+# (video_id, quality) -> {'file_id', 'title', 'artist'} уже загруженных в Telegram треков
+DB_FILE = os.getenv('DB_FILE', 'bot_data.db')
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'sqlite')  # sqlite | json
+CACHE_FLUSH_INTERVAL = float(os.getenv('CACHE_FLUSH_INTERVAL', '2'))
+CACHE_FLUSH_BATCH = int(os.getenv('CACHE_FLUSH_BATCH', '100'))
+
+# Записи из старого кэша без качества считаются самыми слабыми
+LEGACY_QUALITY = 'unknown'
+QUALITY_RANK = {LEGACY_QUALITY: -1, 'low': 0, 'medium': 1, 'high': 2}
+
+def pick_tier(tiers, quality):
+    """Выбирает запись для запрошенного качества.
+
+    Ближайший тир не ниже запрошенного, иначе запись старого кэша без качества.
+    Тир ниже запрошенного - промах: трек скачивается в нужном качестве.
+    """
+    if not tiers:
+        return None
+    want = QUALITY_RANK.get(quality, QUALITY_RANK['high'])
+    ranked = sorted(tiers, key=lambda q: QUALITY_RANK.get(q, -1))
+    for q in ranked:
+        if QUALITY_RANK.get(q, -1) >= want:
+            return tiers[q]
+    return tiers.get(LEGACY_QUALITY)
+
+class TrackStore:
+    """Кэш треков с dict-интерфейсом по ключу (video_id, quality).
+
+    Запись сразу видна, на диск уходит пачками в фоне.
+    """
+
+    def __init__(self, flush_interval=CACHE_FLUSH_INTERVAL, flush_batch=CACHE_FLUSH_BATCH):
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._flush_loop, name='cache-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def get(self, key, default=None):
+        video_id, quality = key
+        value = self.tiers(video_id).get(quality)
+        return default if value is None else value
+
+    def tiers(self, video_id):
+        """Все закэшированные качества трека: {quality: запись}"""
+        with self._lock:
+            tiers = self._read_tiers(video_id)
+            for (vid, quality), value in self._pending.items():
+                if vid == video_id:
+                    tiers[quality] = value
+        return tiers
+
+    def lookup(self, video_id, quality):
+        """Запись для пользователя с данным качеством с учётом pick_tier"""
+        return pick_tier(self.tiers(video_id), quality)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._pending[key] = value
+            full = len(self._pending) >= self.flush_batch
+        if full:
+            self._wakeup.set()
+
+    def __len__(self):
+        with self._lock:
+            return self._count()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            try:
+                self._write(self._pending)
+                self._pending = {}
+            except Exception as e:
+                # Пачка остаётся в памяти и уйдёт со следующим сбросом
+                logger.error(f"Cache flush error: {e}")
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    # Методы бэкенда, вызываются под self._lock
+    def _read_tiers(self, video_id):
+        raise NotImplementedError
+
+    def _write(self, batch):
+        raise NotImplementedError
+
+    def _count(self):
+        raise NotImplementedError
+
+class SqliteTrackStore(TrackStore):
+    """SQLite в режиме WAL: upsert по первичному ключу, чтение без загрузки всего кэша"""
+
+    def __init__(self, path, legacy_json=None, **kwargs):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._migrate_schema()
+        if legacy_json:
+            self._migrate_json(legacy_json)
+        super().__init__(**kwargs)
+
+    def _migrate_schema(self):
+        """Создаёт таблицу tracks; старую схему без quality переносит в тир LEGACY_QUALITY"""
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(tracks)')]
+        if 'quality' in columns:
+            return
+        with self._db:
+            self._db.execute('BEGIN')
+            if columns:
+                self._db.execute('ALTER TABLE tracks RENAME TO tracks_v1')
+            self._db.execute(
+                'CREATE TABLE tracks ('
+                'video_id TEXT NOT NULL, quality TEXT NOT NULL, file_id TEXT NOT NULL, '
+                'title TEXT, artist TEXT, updated_at REAL, '
+                'PRIMARY KEY (video_id, quality))'
+            )
+            if columns:
+                self._db.execute(
+                    'INSERT INTO tracks SELECT video_id, ?, file_id, title, artist, updated_at FROM tracks_v1',
+                    (LEGACY_QUALITY,)
+                )
+                self._db.execute('DROP TABLE tracks_v1')
+
+    def _migrate_json(self, json_path):
+        """Одноразовый перенос старого track_cache.json"""
+        if not os.path.exists(json_path):
+            return
+        if self._db.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
         try:
-            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
+            with open(json_path, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+        except Exception as e:
+            logger.error(f"Legacy cache read error, skipping migration: {e}")
+            return
+        with self._db:
+            self._db.execute('BEGIN')
+            batch = {}
+            for key, data in legacy.items():
+                # Ключи JsonTrackStore - "video_id|quality", в самом старом кэше - просто video_id
+                video_id, _, quality = key.partition('|')
+                batch[(video_id, quality or LEGACY_QUALITY)] = data
+            self._write(batch)
+            self._db.execute("INSERT INTO meta VALUES ('json_migrated', ?)", (str(time.time()),))
+        logger.info(f"Migrated {len(legacy)} tracks from {json_path}")
+
+    def _read_tiers(self, video_id):
+        rows = self._db.execute(
+            'SELECT quality, file_id, title, artist FROM tracks WHERE video_id = ?', (video_id,)
+        ).fetchall()
+        return {row[0]: {'file_id': row[1], 'title': row[2], 'artist': row[3]} for row in rows}
+
+    def _write(self, batch):
+        now = time.time()
+        rows = [
+            (video_id, quality, v['file_id'], v.get('title'), v.get('artist'), now)
+            for (video_id, quality), v in batch.items()
+        ]
+        in_transaction = self._db.in_transaction
+        if not in_transaction:
+            self._db.execute('BEGIN')
+        try:
+            self._db.executemany(
+                'INSERT INTO tracks (video_id, quality, file_id, title, artist, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(video_id, quality) DO UPDATE SET file_id = excluded.file_id, '
+                'title = excluded.title, artist = excluded.artist, updated_at = excluded.updated_at',
+                rows
+            )
+            if not in_transaction:
+                self._db.execute('COMMIT')
+        except BaseException:
+            if not in_transaction:
+                self._db.execute('ROLLBACK')
+            raise
+
+    def _count(self):
+        stored = self._db.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+        # Отложенные записи поверх существующих строк число треков не меняют
+        new = sum(
+            1 for vid, q in self._pending
+            if self._db.execute(
+                'SELECT 1 FROM tracks WHERE video_id = ? AND quality = ?', (vid, q)
+            ).fetchone() is None
+        )
+        return stored + new
+
+class JsonTrackStore(TrackStore):
+    """Старый формат: весь кэш в памяти, файл перезаписывается атомарно и пачками.
+
+    Ключи в файле - "video_id|quality"; ключи без качества (старый кэш) - LEGACY_QUALITY.
+    """
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self._data = {}  # video_id -> {quality: запись}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    for key, value in json.load(f).items():
+                        video_id, _, quality = key.partition('|')
+                        self._data.setdefault(video_id, {})[quality or LEGACY_QUALITY] = value
+            except Exception as e:
+                logger.error(f"Cache load error: {e}")
+        super().__init__(**kwargs)
+
+    def _read_tiers(self, video_id):
+        return dict(self._data.get(video_id, {}))
+
+    def _write(self, batch):
+        data = {video_id: dict(tiers) for video_id, tiers in self._data.items()}
+        for (video_id, quality), value in batch.items():
+            data.setdefault(video_id, {})[quality] = value
+        flat = {
+            f'{video_id}|{quality}': value
+            for video_id, tiers in data.items() for quality, value in tiers.items()
+        }
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(flat, f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._data = data
+
+    def _count(self):
+        stored = sum(len(tiers) for tiers in self._data.values())
+        return stored + sum(1 for vid, q in self._pending if q not in self._data.get(vid, {}))
+
+def open_track_store():
+    if CACHE_BACKEND == 'json':
+        return JsonTrackStore(CACHE_FILE)
+    return SqliteTrackStore(DB_FILE, legacy_json=CACHE_FILE)
+
+TRACK_CACHE = None if IS_WORKER else open_track_store()
+
+# === СОСТОЯНИЕ ПОЛЬЗОВАТЕЛЕЙ ===
+# Лимит скачиваний: RATE_LIMIT_TRACKS в час, токены восполняются равномерно
+RATE_LIMIT_TRACKS = int(os.getenv('RATE_LIMIT_TRACKS', '20'))
+RATE_LIMIT_WINDOW = 3600
+# Неактивные пользователи выгружаются из памяти (в базе остаются)
+USER_IDLE_TTL = float(os.getenv('USER_IDLE_TTL', '3600'))
+USER_FLUSH_INTERVAL = float(os.getenv('USER_FLUSH_INTERVAL', '5'))
+
+class UserState:
+    """Настройки, счётчики и token bucket одного пользователя"""
+    __slots__ = ('user_id', 'quality', 'downloads', 'searches', 'tokens', 'refilled_at', 'last_seen')
+
+    def __init__(self, user_id, quality='high', downloads=0, searches=0,
+                 tokens=RATE_LIMIT_TRACKS, refilled_at=None, last_seen=None):
+        now = time.time()
+        self.user_id = user_id
+        self.quality = quality
+        self.downloads = downloads
+        self.searches = searches
+        self.tokens = tokens
+        self.refilled_at = refilled_at or now
+        self.last_seen = last_seen or now
+
+    def _refill(self, now):
+        rate = RATE_LIMIT_TRACKS / RATE_LIMIT_WINDOW
+        self.tokens = min(RATE_LIMIT_TRACKS, self.tokens + (now - self.refilled_at) * rate)
+        self.refilled_at = now
 
-def save_cache(cache):
+    def can_download(self):
+        self._refill(time.time())
+        return self.tokens >= 1
+
+    def wait_time(self):
+        """Секунд до следующего доступного скачивания"""
+        self._refill(time.time())
+        return max(0.0, (1 - self.tokens) * RATE_LIMIT_WINDOW / RATE_LIMIT_TRACKS)
+
+    def available(self):
+        """Сколько треков можно скачать прямо сейчас"""
+        self._refill(time.time())
+        return int(self.tokens)
+
+    def consume(self):
+        self._refill(time.time())
+        self.tokens = max(0.0, self.tokens - 1)
+
+class UserStore:
+    """Пользователи в SQLite; в памяти только активные, изменения пишутся пачками в фоне"""
+
+    def __init__(self, path, idle_ttl=USER_IDLE_TTL, flush_interval=USER_FLUSH_INTERVAL):
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS users ('
+            'user_id INTEGER PRIMARY KEY, quality TEXT, downloads INTEGER, searches INTEGER, '
+            'tokens REAL, refilled_at REAL, last_seen REAL)'
+        )
+        self._lock = threading.Lock()
+        self._users = {}
+        self._dirty = {}  # user_id -> UserState, ждущие записи
+        self._dirty_lock = threading.Lock()
+        self._closed = False
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name='users-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def get(self, user_id):
+        user = self._users.get(user_id) or self._dirty.get(user_id)
+        if user is None:
+            with self._lock:
+                row = self._db.execute(
+                    'SELECT quality, downloads, searches, tokens, refilled_at, last_seen '
+                    'FROM users WHERE user_id = ?', (user_id,)
+                ).fetchone()
+            user = UserState(user_id, *row) if row else UserState(user_id)
+        self._users[user_id] = user
+        user.last_seen = time.time()
+        return user
+
+    def save(self, user):
+        """Помечает пользователя для записи на диск"""
+        with self._dirty_lock:
+            self._dirty[user.user_id] = user
+
+    def flush(self):
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, {}
+        rows = [
+            (user.user_id, user.quality, user.downloads, user.searches,
+             user.tokens, user.refilled_at, user.last_seen)
+            for user in dirty.values()
+        ]
+        if rows:
+            with self._lock:
+                try:
+                    self._db.execute('BEGIN')
+                    self._db.executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                    self._db.execute('COMMIT')
+                except Exception as e:
+                    self._db.execute('ROLLBACK')
+                    with self._dirty_lock:
+                        self._dirty = {**dirty, **self._dirty}
+                    logger.error(f"User state flush error: {e}")
+                    return
+        # Выгружаем из памяти давно неактивных, уже сохранённых пользователей
+        idle_before = time.time() - self.idle_ttl
+        for user_id, user in list(self._users.items()):
+            if user.last_seen < idle_before and user_id not in self._dirty:
+                self._users.pop(user_id, None)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self.flush()
+
+USERS = None if IS_WORKER else UserStore(DB_FILE)
+
+# === ПЛАНИРОВЩИК И ПУЛЫ ВОРКЕРОВ ===
+# Поиск и скачивание выполняются в отдельных потоках, чтобы не блокировать event loop.
+# Все ресурсы ограничены глобально, а очереди к ним честные: пользователи
+# обслуживаются по кругу, и один активный пользователь не блокирует остальных
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', '4'))
+SEARCH_QUEUE_LIMIT = int(os.getenv('SEARCH_QUEUE_LIMIT', '20'))
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '2'))
+DOWNLOAD_QUEUE_LIMIT = int(os.getenv('DOWNLOAD_QUEUE_LIMIT', '10'))
+MAX_TRANSCODES = int(os.getenv('MAX_TRANSCODES', str(os.cpu_count() or 1)))
+MAX_UPLOADS = int(os.getenv('MAX_UPLOADS', '4'))
+UPLOAD_QUEUE_LIMIT = int(os.getenv('UPLOAD_QUEUE_LIMIT', '20'))
+UPLOAD_BYTES_PER_SEC = int(os.getenv('UPLOAD_BYTES_PER_SEC', '0'))  # 0 - без ограничения
+# thread - потоки этого процесса; process - отдельные процессы, чтобы yt-dlp
+# и mutagen не упирались в GIL и общий event loop
+WORKER_BACKEND = os.getenv('WORKER_BACKEND', 'thread')
+# Процесс-воркер перезапускается после стольких задач (утечки памяти yt-dlp)
+WORKER_MAX_TASKS = int(os.getenv('WORKER_MAX_TASKS', '50'))
+
+# Приоритеты в очередях: меньше - раньше
+PRIORITY_CACHED = 0  # трек уже лежит локально, нужна только отправка
+PRIORITY_NORMAL = 1
+
+class PoolBusy(Exception):
+    """Очередь пула переполнена"""
+    def __init__(self, pool_name, queued):
+        super().__init__(f"{pool_name} pool is busy ({queued} queued)")
+        self.queued = queued
+
+class FairLimiter:
+    """Ограничение числа одновременных задач с честной очередью.
+
+    Ожидающие обслуживаются по приоритету, а внутри приоритета - по кругу
+    между пользователями. Позиция в очереди сообщается через on_queued.
+    """
+
+    def __init__(self, name, limit, queue_limit):
+        self.name = name
+        self.limit = limit
+        self.queue_limit = queue_limit
+        self.running = 0
+        self.queued = 0
+        self._queues = {}  # приоритет -> OrderedDict(user_id -> deque ожидающих)
+        self._notify_tasks = set()
+
+    @property
+    def busy(self):
+        return self.running >= self.limit or self.queued > 0
+
+    def try_acquire(self):
+        """Занимает слот только если он свободен прямо сейчас"""
+        if self.busy:
+            return False
+        self.running += 1
+        return True
+
+    async def acquire(self, user_id=None, priority=PRIORITY_NORMAL, on_queued=None):
+        """Занимает слот; on_queued(position) - корутина, вызывается при
+        постановке в очередь и при каждом продвижении по ней.
+        Если очередь заполнена - PoolBusy.
+        """
+        if self.try_acquire():
+            return
+        if self.queued >= self.queue_limit:
+            raise PoolBusy(self.name, self.queued)
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = [waiter, on_queued, 0]
+        users = self._queues.setdefault(priority, OrderedDict())
+        users.setdefault(user_id, deque()).append(entry)
+        self.queued += 1
+        self._notify_positions()
+        try:
+            await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже передан нам, но мы отменены - отдаём его дальше
+                self.release()
+            elif self._remove(entry, priority, user_id):
+                self._notify_positions()
+            raise
+
+    def release(self):
+        while True:
+            entry = self._pop_next()
+            if entry is None:
+                self.running -= 1
+                return
+            # Передаём слот следующему в очереди, running не меняется
+            if not entry[0].done():
+                entry[0].set_result(None)
+                self._notify_positions()
+                return
+
+    def _pop_next(self):
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            if not users:
+                continue
+            user_id, waiting = next(iter(users.items()))
+            entry = waiting.popleft()
+            if waiting:
+                # Пользователь уходит в конец круга
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            self.queued -= 1
+            return entry
+        return None
+
+    def _remove(self, entry, priority, user_id):
+        waiting = self._queues.get(priority, {}).get(user_id)
+        if not waiting or entry not in waiting:
+            return False
+        waiting.remove(entry)
+        if not waiting:
+            del self._queues[priority][user_id]
+        self.queued -= 1
+        return True
+
+    def _order(self):
+        """Ожидающие в том порядке, в котором их обслужит _pop_next"""
+        for priority in sorted(self._queues):
+            rounds = [list(waiting) for waiting in self._queues[priority].values()]
+            for i in range(max(map(len, rounds), default=0)):
+                for waiting in rounds:
+                    if i < len(waiting):
+                        yield waiting[i]
+
+    def _notify_positions(self):
+        for position, entry in enumerate(self._order(), start=1):
+            callback = entry[1]
+            if callback and entry[2] != position:
+                entry[2] = position
+                task = asyncio.ensure_future(callback(position))
+                self._notify_tasks.add(task)
+                task.add_done_callback(self._notify_tasks.discard)
+
+class CancelToken:
+    """Флаг отмены для процесса-воркера: файл-маркер вместо threading.Event"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def set(self):
+        open(self.path, 'w').close()
+
+    def is_set(self):
+        return os.path.exists(self.path)
+
+    def discard(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+def run_job(fn, *args):
+    """Задача в процессе-воркере: результат или исключение плюс метрики"""
     try:
-        with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(cache, f, ensure_ascii=False, indent=2)
+        result = fn(*args)
     except Exception as e:
-        logger.error(f"Cache save error: {e}")
+        return False, e, METRICS.drain()
+    return True, result, METRICS.drain()
 
-TRACK_CACHE = load_cache()
+class WorkerPool:
+    """Пул потоков или процессов, вход в который регулирует FairLimiter.
 
-# Настройки пользователей (качество аудио)
-USER_SETTINGS = {}
+    Процессы создаются при первой задаче и перезапускаются после
+    WORKER_MAX_TASKS задач; упавший пул пересоздаётся.
+    """
 
-# === УМНЫЙ ПАРСИНГ НАЗВАНИЙ ===
-def clean_title(title):
-    """Убирает весь мусор из названия"""
-    if not title:
-        return "Unknown Track"
-    
-    # Убираем всё после | или - если там есть "Official", "Audio", "Video" и т.д.
-    title = re.sub(r'\s*[\|\-]\s*(Official\s*(Music\s*)?(Video|Audio|Lyric Video)|Lyrics?|HD|4K|Music\s*Video|Audio|MV).*$', '', title, flags=re.IGNORECASE)
-    
-    # Убираем (Official...), [Official...], и т.д.
-    title = re.sub(r'\s*[\(\[\{]\s*(Official|Audio|Video|Lyric|Music|HD|4K|MV|Премьера|Клип).*?[\)\]\}]', '', title, flags=re.IGNORECASE)
-    
-    # Убираем годы в конце (2023), [2024] и т.д.
-    title = re.sub(r'\s*[\(\[\{]?\s*(19|20)\d{2}\s*[\)\]\}]?\s*$', '', title)
-    
-    # Убираем лишние пробелы
-    title = re.sub(r'\s+', ' ', title).strip()
-    
-    return title if title else "Unknown Track"
+    def __init__(self, name, workers, queue_limit, processes=False):
+        self.name = name
+        self.workers = workers
+        self.processes = processes
+        self._executor = None
+        self.slots = FairLimiter(name, workers, queue_limit)
+        self._preemptible = set()
 
-def parse_artist_title(full_title, uploader):
-    """Парсит исполнителя и название из заголовка"""
-    # Очищаем от мусора
-    full_title = clean_title(full_title)
-    
-    # Типичные форматы: "Artist - Title" или "Artist — Title"
-    if ' - ' in full_title or ' – ' in full_title or ' — ' in full_title:
-        parts = re.split(r'\s*[-–—]\s*', full_title, maxsplit=1)
-        if len(parts) == 2:
-            artist = parts[0].strip()
-            title = parts[1].strip()
-            
-            # Убираем "Topic" из исполнителя
-            artist = re.sub(r'\s*-\s*Topic\s*$', '', artist, flags=re.IGNORECASE)
-            artist = artist.replace(' Topic', '').strip()
-            
-            return artist, title
-    
-    # Если нет разделителя, используем uploader как артиста
-    uploader_clean = uploader.replace(' - Topic', '').replace(' Topic', '').strip()
-    uploader_clean = re.sub(r'\s*-\s*Topic\s*$', '', uploader_clean, flags=re.IGNORECASE)
-    
-    return uploader_clean, full_title
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.processes:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    max_tasks_per_child=WORKER_MAX_TASKS or None,
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+        return self._executor
+
+    def cancel_token(self, name):
+        """Флаг отмены для preemptible-задачи, видимый из воркера"""
+        if self.processes:
+            token = CancelToken(os.path.join(TEMP_DIR, '.staging', f'{name}.cancel'))
+            token.discard()
+            return token
+        return threading.Event()
+
+    @property
+    def running(self):
+        return self.slots.running
+
+    @property
+    def queued(self):
+        return self.slots.queued
+
+    async def run(self, fn, *args, on_queued=None, preemptible=None, user_id=None, priority=PRIORITY_NORMAL):
+        """Выполняет fn(*args) в пуле.
+
+        preemptible - threading.Event фоновой задачи: такая задача занимает только
+        свободный воркер, не встаёт в очередь, а когда воркер нужен обычной
+        задаче, событие выставляется и fn должна прерваться.
+        """
+        if preemptible is not None:
+            if not self.slots.try_acquire():
+                raise PoolBusy(self.name, self.slots.queued)
+            self._preemptible.add(preemptible)
+        else:
+            if self.slots.busy:
+                self._preempt()
+            with METRICS.stage(f'{self.name}_queue'):
+                await self.slots.acquire(user_id, priority, on_queued)
+
+        loop = asyncio.get_running_loop()
+
+        def done(_):
+            self._preemptible.discard(preemptible)
+            self.slots.release()
+
+        executor = self.executor
+        try:
+            if self.processes:
+                future = executor.submit(run_job, fn, *args)
+            else:
+                future = executor.submit(fn, *args)
+        except BaseException as e:
+            done(None)
+            if isinstance(e, BrokenProcessPool):
+                self._restart(executor)
+            raise
+        # Слот освобождается только когда воркер реально закончил работу,
+        # даже если ожидающая корутина уже отменена
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(done, None))
+        try:
+            result = await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            self._restart(executor)
+            raise
+        if not self.processes:
+            return result
+        ok, value, metrics = result
+        METRICS.merge(metrics)
+        if not ok:
+            raise value
+        return value
+
+    def _restart(self, broken):
+        """Воркер умер (OOM, сигнал) - пул сломан, поднимаем новый"""
+        if self._executor is not broken:
+            return
+        logger.error(f"{self.name} worker pool broken, restarting")
+        METRICS.inc('errors_total', stage=f'{self.name}_pool', type='BrokenProcessPool')
+        self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _preempt(self):
+        """Прерывает одну фоновую задачу, чтобы освободить воркер"""
+        for event in self._preemptible:
+            if not event.is_set():
+                event.set()
+                return
+
+class BandwidthLimiter:
+    """Средняя скорость исходящего трафика: каждая отправка резервирует
+    своё время в общем канале и при необходимости ждёт очереди
+    """
+
+    def __init__(self, bytes_per_sec):
+        self.bytes_per_sec = bytes_per_sec
+        self._available_at = 0.0
+
+    async def consume(self, nbytes):
+        if not self.bytes_per_sec:
+            return
+        now = time.monotonic()
+        start = max(now, self._available_at)
+        self._available_at = start + nbytes / self.bytes_per_sec
+        if start > now:
+            await asyncio.sleep(start - now)
+
+SEARCH_POOL = WorkerPool('search', SEARCH_WORKERS, SEARCH_QUEUE_LIMIT, WORKER_BACKEND == 'process')
+DOWNLOAD_POOL = WorkerPool('download', DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_LIMIT, WORKER_BACKEND == 'process')
+# ffmpeg-перекодирование выполняется в воркерах DOWNLOAD_POOL; в режиме
+# процессов семафор у каждого свой, и перекодирования ограничены DOWNLOAD_WORKERS
+TRANSCODE_SLOTS = threading.BoundedSemaphore(MAX_TRANSCODES)
+UPLOAD_SLOTS = FairLimiter('upload', MAX_UPLOADS, UPLOAD_QUEUE_LIMIT)
+UPLOAD_BANDWIDTH = BandwidthLimiter(UPLOAD_BYTES_PER_SEC)
 
 # === НАСТРОЙКИ ЗАГРУЗЧИКА ===
+# remux - предпочитаем AAC-потоки и только перепаковываем их в m4a,
+#         остальное перекодируем
+# native - как remux, но Opus отправляем как есть в контейнере Ogg.
+#          Bot API описывает sendAudio только для MP3/M4A: Ogg Telegram может
+#          сохранить как голосовое или документ. Такой трек доходит до чата,
+#          но в TRACK_CACHE не попадает и каждый раз качается заново
+# transcode - всегда перекодируем в AAC (старое поведение)
+AUDIO_MODE = os.getenv('AUDIO_MODE', 'remux')
+
+_LEGACY_FORMATS = {
+    'high': 'bestaudio[abr>=256]/bestaudio/best',
+    'medium': 'bestaudio[abr>=128][abr<=192]/bestaudio/best',
+    'low': 'bestaudio[abr<=128]/worstaudio/best',
+}
+AUDIO_FORMATS = {
+    'transcode': _LEGACY_FORMATS,
+    'remux': {
+        'high': 'bestaudio[ext=m4a][abr>=256]/bestaudio[abr>=256]/bestaudio[ext=m4a]/bestaudio/best',
+        'medium': 'bestaudio[ext=m4a][abr<=192]/bestaudio[abr>=128][abr<=192]/bestaudio/best',
+        'low': 'bestaudio[ext=m4a][abr<=128]/bestaudio[abr<=128]/worstaudio/best',
+    },
+    'native': {
+        'high': 'bestaudio[acodec=opus]/bestaudio[ext=m4a]/bestaudio/best',
+        'medium': 'bestaudio[acodec=opus][abr<=160]/bestaudio[ext=m4a][abr<=192]/bestaudio/best',
+        'low': 'bestaudio[acodec=opus][abr<=96]/bestaudio[abr<=128]/worstaudio/best',
+    },
+}
+if AUDIO_MODE not in AUDIO_FORMATS:
+    logger.warning(f"Unknown AUDIO_MODE={AUDIO_MODE}, using 'remux'")
+    AUDIO_MODE = 'remux'
+
+# Битрейт AAC, когда перекодирования не избежать
+TRANSCODE_BITRATES = {'high': '256k', 'medium': '160k', 'low': '96k'}
+
+# YTDL_CONCURRENT_FRAGMENTS ускоряет только форматы из фрагментов (DASH/HLS).
+# Обычный HTTP-поток, как аудио YouTube, качается в одно соединение: YTDL_CHUNK_MB
+# лишь режет его на последовательные ranged-запросы, чтобы не упираться в
+# троттлинг длинных ответов. Несколько соединений на поток даёт только внешний
+# загрузчик (ниже). Недокачанный .part в staging подхватывается следующей попыткой
+YTDL_CONCURRENT_FRAGMENTS = int(os.getenv('YTDL_CONCURRENT_FRAGMENTS', '4'))
+YTDL_CHUNK_MB = int(os.getenv('YTDL_CHUNK_MB', '10'))  # 0 - одним запросом
+YTDL_RETRIES = int(os.getenv('YTDL_RETRIES', '10'))
+# Внешний загрузчик, например aria2c с YTDL_EXTERNAL_ARGS='-x 8 -s 8 -k 1M'
+YTDL_EXTERNAL_DOWNLOADER = os.getenv('YTDL_EXTERNAL_DOWNLOADER')
+YTDL_EXTERNAL_ARGS = os.getenv('YTDL_EXTERNAL_ARGS', '')
+# Попытки целиком (с новым извлечением ссылок), докачка продолжает .part
+DOWNLOAD_ATTEMPTS = int(os.getenv('DOWNLOAD_ATTEMPTS', '2'))
+
+# Лимиты проверяются по метаданным до скачивания
+MAX_TRACK_DURATION = int(os.getenv('MAX_TRACK_DURATION', '10800'))  # секунды, 0 - без лимита
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_MB', '50')) * 1024 * 1024  # лимит Bot API
+# Выше этого битрейта аудио YouTube не бывает: короткие треки не проверяем
+MAX_AUDIO_BYTES_PER_SEC = 320 * 1000 // 8
+# Ниже этого битрейта подгонять трек под лимит уже бессмысленно
+MIN_FIT_KBPS = 48
+
+# Сколько раз сработал каждый путь обработки аудио: remux / native / transcode.
+# Считается в основном процессе по meta['audio_path'] от воркера
+AUDIO_PATH_STATS = Counter()
+
+@functools.cache
+def ffmpeg_exe():
+    """Путь к ffmpeg из imageio_ffmpeg, определяется один раз"""
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
 def get_ydl_opts(is_download=False, filepath=None, quality='best'):
     """Настройки yt-dlp с поддержкой выбора качества"""
-    
-    # Получаем путь к ffmpeg из библиотеки
-    ffmpeg_path = imageio_ffmpeg.get_ffmpeg_exe()
+    tier = quality if quality in ('high', 'medium') else 'low'
+    # Копия заготовки: вызывающий код дописывает свои ключи (progress_hooks)
+    opts = dict(_static_ydl_opts(is_download, tier if is_download else None))
+    if is_download:
+        opts['outtmpl'] = filepath
+    return opts
 
+@functools.cache
+def _static_ydl_opts(is_download, tier):
+    """Неизменная часть настроек, собирается один раз на режим и качество"""
     opts = {
         'quiet': True,
         'no_warnings': True,
-        'ffmpeg_location': ffmpeg_path,  # <--- ЯВНО УКАЗЫВАЕМ ПУТЬ
+        'ffmpeg_location': ffmpeg_exe(),  # <--- ЯВНО УКАЗЫВАЕМ ПУТЬ
         'extractor_args': {
             'youtube': {
                 'player_client': ['android', 'web'],
@@ -119,20 +1054,19 @@ def get_ydl_opts(is_download=False, filepath=None, quality='best'):
     
     if is_download:
         # Выбор качества
-        if quality == 'high':
-            opts['format'] = 'bestaudio[abr>=256]/bestaudio/best'
-        elif quality == 'medium':
-            opts['format'] = 'bestaudio[abr>=128][abr<=192]/bestaudio/best'
-        else:  # low
-            opts['format'] = 'bestaudio[abr<=128]/worstaudio/best'
-            
+        opts['format'] = AUDIO_FORMATS[AUDIO_MODE][tier]
         opts['writethumbnail'] = True
-        opts['outtmpl'] = filepath
         opts['extract_flat'] = False
-        opts['postprocessors'] = [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'm4a',
-        }]
+        opts['continuedl'] = True
+        opts['retries'] = YTDL_RETRIES
+        opts['fragment_retries'] = YTDL_RETRIES
+        opts['concurrent_fragment_downloads'] = YTDL_CONCURRENT_FRAGMENTS
+        if YTDL_CHUNK_MB:
+            opts['http_chunk_size'] = YTDL_CHUNK_MB * 1024 * 1024
+        if YTDL_EXTERNAL_DOWNLOADER:
+            opts['external_downloader'] = {'default': YTDL_EXTERNAL_DOWNLOADER}
+            opts['external_downloader_args'] = {'default': shlex.split(YTDL_EXTERNAL_ARGS)}
+        # Конвертацию делает convert_audio: копирование потока, когда это возможно
     else:
         opts['extract_flat'] = True
         opts['skip_download'] = True
@@ -142,7 +1076,7 @@ def get_ydl_opts(is_download=False, filepath=None, quality='best'):
 # === КОМАНДА START ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    bot_username = (await context.bot.get_me()).username
+    bot_username = context.bot.username
     
     welcome_text = f'''🎵 <b>Добро пожаловать в Music Bot!</b>
 
@@ -152,6 +1086,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 <b>1️⃣ В личке или группе:</b>
 /find название песни - поиск музыки
+/playlist ссылка - весь плейлист или альбом
 
 <b>2️⃣ В любом чате (inline режим):</b>
 @{bot_username} название песни
@@ -186,13 +1121,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # === ПОМОЩЬ ===
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    bot_username = (await context.bot.get_me()).username
+    bot_username = context.bot.username
     
     help_text = f'''❓ <b>Справка по использованию</b>
 
 <b>🔍 Поиск музыки:</b>
 /find [название] - поиск треков
 Пример: <code>/find The Weeknd Blinding Lights</code>
+Кнопка «☑️ Выбрать несколько» - скачать сразу несколько результатов
+
+<b>📃 Плейлисты и альбомы:</b>
+/playlist [ссылка на YouTube] - до {PLAYLIST_MAX_TRACKS} треков по порядку
 
 <b>🌐 Inline режим (в любом чате):</b>
 @{bot_username} [название]
@@ -213,7 +1152,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Кэшированные треки отправляются мгновенно
 
 <b>⚡ Лимиты:</b>
-20 треков в час на пользователя'''
+{RATE_LIMIT_TRACKS} треков в час на пользователя'''
     
     keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_start")]]
     
@@ -229,7 +1168,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # === НАСТРОЙКИ ===
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    current = USER_SETTINGS.get(user_id, 'high')
+    current = USERS.get(user_id).quality
     
     quality_names = {"high": "🔥 High", "medium": "⚡ Medium", "low": "💾 Low"}
     
@@ -266,14 +1205,13 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # === СТАТИСТИКА ===
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user_data = context.user_data
+    user = USERS.get(update.effective_user.id)
     
-    downloads = user_data.get('downloads', 0)
-    searches = user_data.get('searches', 0)
+    downloads = user.downloads
+    searches = user.searches
     
     quality_names = {"high": "🔥 High", "medium": "⚡ Medium", "low": "💾 Low"}
-    current_quality = quality_names.get(USER_SETTINGS.get(user_id, 'high'))
+    current_quality = quality_names.get(user.quality)
     
     text = f'''📊 <b>Твоя статистика</b>
 
@@ -295,49 +1233,745 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 # === ПОИСК ===
+@METRICS.timed('search')
 def search_youtube(query, max_results=10):
+    import yt_dlp
     try:
         with yt_dlp.YoutubeDL(get_ydl_opts(is_download=False)) as ydl:
             res = ydl.extract_info(f"ytsearch{max_results}:{query}", download=False)
             return res.get('entries', [])
     except Exception as e:
         logger.error(f"Search Error: {e}")
+        METRICS.inc('errors_total', stage='search', type=type(e).__name__)
         return []
 
+# === КЭШ ПОИСКА ===
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '1000'))
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL', '600'))
+
+def normalize_query(query):
+    """Ключ кэша: регистр и лишние пробелы не важны"""
+    return ' '.join(query.casefold().split())
+
+class SearchCache:
+    """LRU-кэш результатов поиска с TTL.
+
+    Результат, полученный с большим max_results, обслуживает и запросы
+    с меньшим: 15 результатов inline-поиска подходят и для /find на 5.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # ключ -> (истекает, запрошено, результаты)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query, max_results):
+        key = normalize_query(query)
+        entry = self._entries.get(key)
+        if entry:
+            expires, fetched, results = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+            # Если YouTube вернул меньше, чем просили, больше результатов нет
+            elif fetched >= max_results or len(results) < fetched:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return results[:max_results]
+        self.misses += 1
+        return None
+
+    def put(self, query, max_results, results):
+        if not results:
+            # Пустой ответ обычно означает ошибку поиска - не кэшируем
+            return
+        key = normalize_query(query)
+        self._entries[key] = (time.monotonic() + self.ttl, max_results, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+SEARCH_CACHE = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+async def search_async(query, max_results=10, on_queued=None, user_id=None):
+    """Поиск через SEARCH_CACHE, при промахе - search_youtube в SEARCH_POOL"""
+    results = SEARCH_CACHE.get(query, max_results)
+    if results is not None:
+        return results
+    results = await SEARCH_POOL.run(search_youtube, query, max_results, on_queued=on_queued, user_id=user_id)
+    SEARCH_CACHE.put(query, max_results, results)
+    return results
+
 def format_duration(seconds):
     if not seconds: return '?:??'
     s = int(seconds)
     return f'{s // 60}:{s % 60:02d}'
 
-def download_thumbnail(url, video_id):
+# === ОБЛОЖКИ ===
+# Telegram принимает превью не больше 320x320 и 200 КБ
+THUMB_SIZE = 320
+THUMB_CACHE_SIZE = int(os.getenv('THUMB_CACHE_SIZE', '256'))
+
+# video_id -> готовые JPEG-байты обложки
+THUMB_CACHE = OrderedDict()
+_thumb_lock = threading.Lock()
+
+THUMB_HTTP_POOL = int(os.getenv('THUMB_HTTP_POOL', str(DOWNLOAD_WORKERS)))
+THUMB_HTTP_TIMEOUT = float(os.getenv('THUMB_HTTP_TIMEOUT', '10'))
+
+@functools.cache
+def http2_available():
+    """HTTP/2 нужен пакет h2 (экстра python-telegram-bot[http2])"""
     try:
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            img_path = os.path.join(TEMP_DIR, f'{video_id}_thumb.jpg')
-            img = Image.open(BytesIO(response.content))
-            if img.mode != 'RGB': 
-                img = img.convert('RGB')
-            img.save(img_path, 'JPEG', quality=90)
-            return img_path
-    except: 
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+@functools.cache
+def http_client():
+    """Общий пул соединений к CDN обложек, если yt-dlp не сохранил обложку сам.
+    Синхронный: обложки готовятся в потоках и процессах загрузчика.
+    """
+    import httpx
+    return httpx.Client(
+        http2=http2_available(),
+        timeout=httpx.Timeout(THUMB_HTTP_TIMEOUT, connect=5),
+        limits=httpx.Limits(max_connections=THUMB_HTTP_POOL, max_keepalive_connections=THUMB_HTTP_POOL),
+        follow_redirects=True,
+    )
+
+def written_thumbnail(info):
+    """Путь к обложке, которую yt-dlp сохранил при writethumbnail"""
+    for thumb in reversed(info.get('thumbnails') or []):
+        if thumb.get('filepath') and os.path.exists(thumb['filepath']):
+            return thumb['filepath']
+    return None
+
+@METRICS.timed('thumbnail')
+def prepare_thumbnail(video_id, thumb_file=None, url=None):
+    """Одна стадия обложки: файл от yt-dlp или одна загрузка по url,
+    уменьшение до THUMB_SIZE в памяти, кэш JPEG-байтов по video_id.
+    """
+    with _thumb_lock:
+        if video_id in THUMB_CACHE:
+            THUMB_CACHE.move_to_end(video_id)
+            return THUMB_CACHE[video_id]
+    try:
+        if thumb_file:
+            with open(thumb_file, 'rb') as f:
+                raw = f.read()
+        elif url:
+            response = http_client().get(url)
+            if response.status_code != 200:
+                return None
+            raw = response.content
+        else:
+            return None
+
+        from PIL import Image
+        img = Image.open(BytesIO(raw))
+        if img.mode != 'RGB': 
+            img = img.convert('RGB')
+        img.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        buf = BytesIO()
+        img.save(buf, 'JPEG', quality=85)
+        cover = buf.getvalue()
+    except Exception as e:
+        logger.error(f"Thumbnail error: {e}")
+        METRICS.inc('errors_total', stage='thumbnail', type=type(e).__name__)
         return None
 
-def add_metadata_and_cover(file_path, title, artist, thumbnail_path=None):
+    with _thumb_lock:
+        THUMB_CACHE[video_id] = cover
+        while len(THUMB_CACHE) > THUMB_CACHE_SIZE:
+            THUMB_CACHE.popitem(last=False)
+    return cover
+
+@METRICS.timed('tag')
+def add_metadata_and_cover(file_path, title, artist, cover=None, ext=None):
+    """Теги и обложка через mutagen; file_path - путь или BytesIO (тогда нужен ext)"""
     try:
-        ext = os.path.splitext(file_path)[1].lower()
+        ext = ext or os.path.splitext(file_path)[1].lower()
         if ext == '.m4a':
+            from mutagen.mp4 import MP4, MP4Cover
             audio = MP4(file_path)
             audio['\xa9nam'] = title
             audio['\xa9ART'] = artist
-            if thumbnail_path and os.path.exists(thumbnail_path):
-                with open(thumbnail_path, 'rb') as f:
-                    audio['covr'] = [MP4Cover(f.read(), imageformat=MP4Cover.FORMAT_JPEG)]
-            audio.save()
+            if cover:
+                audio['covr'] = [MP4Cover(cover, imageformat=MP4Cover.FORMAT_JPEG)]
+            audio.save(file_path)
+        elif ext == '.opus':
+            from mutagen.flac import Picture
+            from mutagen.oggopus import OggOpus
+            audio = OggOpus(file_path)
+            audio['title'] = title
+            audio['artist'] = artist
+            if cover:
+                picture = Picture()
+                picture.type = 3  # обложка альбома
+                picture.mime = 'image/jpeg'
+                picture.data = cover
+                audio['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+            audio.save(file_path)
     except Exception as e:
         logger.error(f"Metadata error: {e}")
+        METRICS.inc('errors_total', stage='tag', type=type(e).__name__)
+
+# === ЛОКАЛЬНЫЙ КЭШ АУДИО ===
+# Готовые файлы остаются в TEMP_DIR, пока помещаются в бюджет: повторный
+# запрос горячего трека стоит только загрузки в Telegram
+AUDIO_CACHE_BYTES = int(os.getenv('AUDIO_CACHE_MB', '1024')) * 1024 * 1024
+# Недавно выданные файлы не вытесняются - их может отправлять другой запрос
+AUDIO_CACHE_GRACE = float(os.getenv('AUDIO_CACHE_GRACE', '120'))
+JANITOR_INTERVAL = float(os.getenv('JANITOR_INTERVAL', '600'))
+# Файлы вне индекса старше этого возраста - мусор от упавших загрузок
+STALE_FILE_AGE = float(os.getenv('STALE_FILE_AGE', '3600'))
+
+class AudioCache:
+    """LRU-кэш готовых аудиофайлов с бюджетом в байтах.
+
+    Рядом с каждым файлом лежит JSON с метаданными, по ним индекс
+    восстанавливается при старте. Загрузки идут в staging и переносятся
+    в кэш атомарным os.replace.
+    """
+
+    def __init__(self, root, max_bytes, owner=True):
+        self.root = root
+        self.staging = os.path.join(root, '.staging')
+        os.makedirs(self.staging, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (video_id, quality) -> трек, от старых к новым
+        # Запрошенный ключ -> ключ файла, когда запрошенное качество не влезло в лимит
+        self._aliases = {}
+        # Процессу-воркеру нужен только staging: индекс и уборка - в главном
+        if owner:
+            self._rebuild()
+            threading.Thread(target=self._janitor_loop, name='audio-janitor', daemon=True).start()
+
+    def staging_path(self, name):
+        return os.path.join(self.staging, name)
+
+    def get(self, key):
+        """Трек по ключу; файл пониженного качества находится и по запрошенному.
+        Такой трек помечается 'requested' - как результат run_fetch."""
+        with self._lock:
+            requested = key
+            key = self._aliases.get(requested, requested)
+            track = self._entries.get(key)
+            if track is not None and not os.path.exists(track['path']):
+                self._drop(key)
+                track = None
+            if track is None:
+                self._aliases.pop(requested, None)
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            track['used'] = time.time()
+            self.stats['hits'] += 1
+        # mtime хранит порядок LRU между перезапусками
+        os.utime(track['path'])
+        if key != requested:
+            return dict(track, requested=requested[1])
+        return dict(track)
+
+    def put(self, key, staged_path, meta, requested=None):
+        """Переносит готовый файл из staging в кэш и возвращает трек.
+
+        requested - качество, которое просили, если файл получился ниже:
+        get() найдёт файл и по нему.
+        """
+        video_id, quality = key
+        with self._lock:
+            self._aliases.pop(key, None)
+            if requested and requested != quality:
+                self._aliases[(video_id, requested)] = key
+            aliases = sorted(q for (vid, q), target in self._aliases.items() if target == key)
+        base = os.path.join(self.root, f'{video_id}_{quality}')
+        path = base + os.path.splitext(staged_path)[1]
+        os.replace(staged_path, path)
+
+        sidecar = base + '.json'
+        cover = meta.get('cover')
+        record = {
+            'video_id': video_id,
+            'quality': quality,
+            'file': os.path.basename(path),
+            'title': meta['title'],
+            'artist': meta['artist'],
+            'duration': meta['duration'],
+            'cover': base64.b64encode(cover).decode('ascii') if cover else None,
+            'requested': aliases,
+        }
+        with open(sidecar + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(sidecar + '.tmp', sidecar)
+
+        track = {**meta, 'path': path, 'quality': quality}
+        with self._lock:
+            old = self._entries.get(key)
+            if old:
+                self._drop(key)
+                if old['path'] != path:
+                    self._remove_files(old)
+            self._add(key, track, sidecar, time.time())
+            victims = self._evict()
+        for victim in victims:
+            self._remove_files(victim)
+        return dict(track)
+
+    def sweep(self):
+        """Удаляет из TEMP_DIR и staging старые файлы, которых нет в индексе"""
+        with self._lock:
+            known = set()
+            for track in self._entries.values():
+                known.update((track['path'], track['sidecar']))
+        now = time.time()
+        for directory in (self.root, self.staging):
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if path in known or not os.path.isfile(path):
+                    continue
+                try:
+                    if now - os.path.getmtime(path) > STALE_FILE_AGE:
+                        os.remove(path)
+                        self.stats['reclaimed'] += 1
+                except OSError:
+                    pass
+
+    def _rebuild(self):
+        found = []
+        for name in os.listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+            sidecar = os.path.join(self.root, name)
+            try:
+                with open(sidecar, 'r', encoding='utf-8') as f:
+                    record = json.load(f)
+                path = os.path.join(self.root, record['file'])
+                used = os.path.getmtime(path)
+            except (OSError, ValueError, KeyError):
+                continue
+            track = {
+                'path': path,
+                'quality': record['quality'],
+                'title': record['title'],
+                'artist': record['artist'],
+                'duration': record['duration'],
+                'cover': base64.b64decode(record['cover']) if record.get('cover') else None,
+            }
+            found.append((used, (record['video_id'], record['quality']), track, sidecar))
+            for requested in record.get('requested') or []:
+                self._aliases[(record['video_id'], requested)] = (record['video_id'], record['quality'])
+        for used, key, track, sidecar in sorted(found, key=lambda item: item[0]):
+            self._add(key, track, sidecar, used)
+        victims = self._evict()
+        for victim in victims:
+            self._remove_files(victim)
+        logger.info(f"Audio cache: {len(self._entries)} files, {self.total_bytes // (1024 * 1024)} MB")
+
+    def _add(self, key, track, sidecar, used):
+        track['sidecar'] = sidecar
+        track['size'] = os.path.getsize(track['path'])
+        track['used'] = used
+        self._entries[key] = track
+        self.total_bytes += track['size']
+
+    def _drop(self, key):
+        track = self._entries.pop(key)
+        self.total_bytes -= track['size']
+        return track
+
+    def _evict(self):
+        """Вытесняет давно не использованные файлы, пока кэш больше бюджета"""
+        victims = []
+        now = time.time()
+        for key in list(self._entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if now - self._entries[key]['used'] < AUDIO_CACHE_GRACE:
+                continue
+            victims.append(self._drop(key))
+            self.stats['evicted'] += 1
+        return victims
+
+    def _remove_files(self, track):
+        for path in (track['path'], track.get('sidecar')):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    def _janitor_loop(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Janitor error: {e}")
+            time.sleep(JANITOR_INTERVAL)
+
+AUDIO_CACHE = AudioCache(TEMP_DIR, AUDIO_CACHE_BYTES, owner=not IS_WORKER)
 
 # === СКАЧИВАНИЕ И ОТПРАВКА ===
+class TrackTooLarge(Exception):
+    """Трек не укладывается в лимиты длительности или размера"""
+
+def audio_path(acodec, quality, bitrate=None):
+    """Путь обработки для convert_audio: (путь, расширение, аргументы кодека)"""
+    acodec = (acodec or '').lower()
+    if bitrate:
+        return 'transcode', '.m4a', ['-c:a', 'aac', '-b:a', bitrate]
+    if AUDIO_MODE != 'transcode' and acodec.startswith(('mp4a', 'aac')):
+        return 'remux', '.m4a', ['-c:a', 'copy']
+    if AUDIO_MODE == 'native' and acodec == 'opus':
+        return 'native', '.opus', ['-c:a', 'copy']
+    return 'transcode', '.m4a', ['-c:a', 'aac', '-b:a', TRANSCODE_BITRATES.get(quality, '256k')]
+
+def estimate_size(info, quality):
+    """Ожидаемый размер файла после convert_audio для выбранного формата, байт"""
+    duration = info.get('duration') or 0
+    path, _, codec_args = audio_path(info.get('acodec'), quality)
+    if path == 'transcode':
+        return duration * int(codec_args[-1].rstrip('k')) * 1000 // 8
+    size = info.get('filesize') or info.get('filesize_approx')
+    if size:
+        return size
+    return duration * (info.get('abr') or info.get('tbr') or 0) * 1000 // 8
+
+def fit_bitrate(duration):
+    """Битрейт AAC, с которым трек влезает в MAX_UPLOAD_BYTES"""
+    kbps = int(MAX_UPLOAD_BYTES * 0.95 * 8 / 1000 / duration) if duration else 0
+    if kbps < MIN_FIT_KBPS:
+        raise TrackTooLarge(f'трек больше {MAX_UPLOAD_BYTES // (1024 * 1024)} МБ')
+    return f'{min(kbps, 256)}k'
+
+def fallback_tiers(quality):
+    """Запрошенное качество и все, что ниже, от лучшего к худшему"""
+    rank = QUALITY_RANK.get(quality, QUALITY_RANK['high'])
+    return [tier for tier in ('high', 'medium', 'low') if QUALITY_RANK[tier] <= rank]
+
+def check_limits(info):
+    """Отказ до скачивания: прямые эфиры и слишком длинные треки"""
+    if info.get('is_live'):
+        raise TrackTooLarge('это прямой эфир')
+    duration = info.get('duration') or 0
+    if MAX_TRACK_DURATION and duration > MAX_TRACK_DURATION:
+        raise TrackTooLarge(f'трек длиннее {format_duration(MAX_TRACK_DURATION)}')
+
+def plan_download(raw, quality, filepath):
+    """Качество (и битрейт подгонки), при котором файл влезет в лимит Bot API.
+
+    raw - результат extract_info(process=False); выбор формата повторяется
+    для каждого качества ниже запрошенного, сам raw не меняется.
+    """
+    import yt_dlp
+    duration = raw.get('duration') or 0
+    if duration * MAX_AUDIO_BYTES_PER_SEC <= MAX_UPLOAD_BYTES:
+        return quality, None
+    for tier in fallback_tiers(quality):
+        with yt_dlp.YoutubeDL(get_ydl_opts(is_download=True, filepath=filepath, quality=tier)) as ydl:
+            selected = ydl.process_ie_result(copy.deepcopy(raw), download=False)
+        if estimate_size(selected, tier) <= MAX_UPLOAD_BYTES:
+            return tier, None
+    # Даже низкое качество не влезает - перекодируем под лимит
+    return 'low', fit_bitrate(duration)
+
+@METRICS.timed('convert')
+def convert_audio(src_path, base_path, acodec, quality, title, artist, cover=None, bitrate=None):
+    """Готовит файл для Telegram за один проход ffmpeg: поток копируется,
+    когда это возможно, теги и обложка пишутся в том же проходе.
+    bitrate - перекодировать в AAC с этим битрейтом в любом случае.
+
+    Возвращает (путь к результату, путь обработки: remux / native / transcode).
+    """
+    path, ext, codec_args = audio_path(acodec, quality, bitrate)
+
+    out_path = base_path + ext
+    tag_args = ['-map_metadata', '-1', '-metadata', f'title={title}', '-metadata', f'artist={artist}']
+    # Обложка приходит через stdin; Ogg не умеет attached_pic, туда её добавит mutagen
+    embed_cover = bool(cover) and ext == '.m4a'
+
+    def build_cmd(with_cover):
+        cmd = [ffmpeg_exe(), '-y', '-loglevel', 'error', '-i', src_path]
+        if with_cover:
+            cmd += ['-f', 'image2pipe', '-i', 'pipe:0', '-map', '0:a', '-map', '1:v',
+                    '-c:v', 'copy', '-disposition:v:0', 'attached_pic']
+        else:
+            cmd += ['-map', '0:a']
+        cmd += codec_args + tag_args
+        # Ogg пишем в pipe и дописываем обложку в памяти - файл на диск пишется один раз
+        cmd += ['-f', 'opus', 'pipe:1'] if ext == '.opus' else [out_path]
+        return cmd
+
+    # Копирование потока дешёвое, глобально ограничиваем только перекодирование
+    with TRANSCODE_SLOTS if path == 'transcode' else contextlib.nullcontext():
+        result = subprocess.run(build_cmd(embed_cover), input=cover if embed_cover else None, capture_output=True)
+        if result.returncode != 0 and embed_cover:
+            # Старые сборки ffmpeg не пишут обложку в mp4 - теги без неё, обложку добавит mutagen
+            logger.warning(f"ffmpeg cover embed failed, retrying without cover: {result.stderr.decode(errors='replace').strip()}")
+            embed_cover = False
+            result = subprocess.run(build_cmd(False), capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode(errors='replace').strip()}")
+
+    if ext == '.opus':
+        buf = BytesIO(result.stdout)
+        add_metadata_and_cover(buf, title, artist, cover, ext='.opus')
+        with open(out_path, 'wb') as f:
+            f.write(buf.getbuffer())
+    elif cover and not embed_cover:
+        add_metadata_and_cover(out_path, title, artist, cover)
+
+    return out_path, path
+
+def download_source(video_id, quality, cancel=None):
+    """Скачивает исходник в staging с учётом лимитов.
+
+    Метаданные извлекаются без скачивания, по ним проверяются длительность
+    и размер и при необходимости выбирается качество ниже. Неудачная попытка
+    повторяется с новыми ссылками, уже скачанный .part докачивается.
+    Возвращает (info, путь к исходнику, качество, битрейт подгонки).
+    """
+    import yt_dlp
+    video_url = f'https://www.youtube.com/watch?v={video_id}'
+
+    def check_cancel(_):
+        if cancel is not None and cancel.is_set():
+            raise yt_dlp.utils.DownloadCancelled(f'{video_id} preempted')
+
+    # Имя по запрошенному качеству: у загрузки одного ключа оно одно (INFLIGHT_FETCHES),
+    # а загрузки с разными запрошенными качествами, опустившиеся до одного тира,
+    # не пишут в общие файлы. Исходник с отдельным суффиксом, чтобы remux
+    # m4a -> m4a не писал сам в себя; format_id в имени не даёт докачать .part
+    # другим форматом, а повторная попытка докачивает свой
+    src_template = AUDIO_CACHE.staging_path(f'{video_id}_{quality}') + '.src.%(format_id)s.%(ext)s'
+
+    attempts = max(1, DOWNLOAD_ATTEMPTS)
+    for attempt in range(1, attempts + 1):
+        with METRICS.stage('extract'), yt_dlp.YoutubeDL(get_ydl_opts(is_download=False)) as ydl:
+            raw = ydl.extract_info(video_url, download=False, process=False)
+        check_limits(raw)
+
+        tier, bitrate = plan_download(raw, quality, src_template)
+        if tier != quality or bitrate:
+            logger.info(f"Audio {video_id}: {quality} too large for upload, using {tier} {bitrate or ''}")
+        opts = get_ydl_opts(is_download=True, filepath=src_template, quality=tier)
+        opts['progress_hooks'] = [check_cancel]
+        try:
+            with METRICS.stage('download'), yt_dlp.YoutubeDL(opts) as ydl:
+                info = ydl.process_ie_result(raw, download=True)
+                downloads = info.get('requested_downloads') or [{}]
+                src_path = downloads[0].get('filepath') or ydl.prepare_filename(info)
+            return info, src_path, tier, bitrate
+        except yt_dlp.utils.DownloadCancelled:
+            raise
+        except yt_dlp.utils.DownloadError as e:
+            if attempt == attempts or (cancel is not None and cancel.is_set()):
+                raise
+            logger.warning(f"Download {video_id} failed (attempt {attempt}), resuming: {e}")
+
+@METRICS.timed('fetch')
+def prepare_track(video_id, quality, cancel=None):
+    """Скачивает трек и готовит аудио с тегами через convert_audio.
+
+    Блокирующая функция - выполняется в воркере DOWNLOAD_POOL. Выставленный
+    cancel (threading.Event или CancelToken) прерывает скачивание с
+    DownloadCancelled. Возвращает (файл в staging, метаданные) для AUDIO_CACHE;
+    meta['quality'] - качество, которое реально поместилось в лимит,
+    meta['audio_path'] - путь обработки для AUDIO_PATH_STATS.
+    """
+    import yt_dlp
+    # Staging по запрошенному качеству - как исходник в download_source
+    base_path = AUDIO_CACHE.staging_path(f'{video_id}_{quality}')
+    info, src_path, quality, bitrate = download_source(video_id, quality, cancel)
+
+    full_title = info.get('title', 'Unknown')
+    uploader = info.get('uploader', 'Unknown Artist')
+
+    # УМНЫЙ ПАРСИНГ
+    artist, title = parse_artist_title(full_title, uploader)
+
+    try:
+        # Обложку уже скачал yt-dlp - повторно не качаем
+        thumb_file = written_thumbnail(info)
+        try:
+            cover = prepare_thumbnail(video_id, thumb_file, info.get('thumbnail'))
+        finally:
+            if thumb_file:
+                os.remove(thumb_file)
+
+        if cancel is not None and cancel.is_set():
+            raise yt_dlp.utils.DownloadCancelled(f'{video_id} preempted')
+        final_filename, path = convert_audio(
+            src_path, base_path, info.get('acodec'), quality, title, artist, cover, bitrate
+        )
+        if os.path.getsize(final_filename) > MAX_UPLOAD_BYTES:
+            # Оценка по метаданным промахнулась - подгоняем битрейт по исходнику
+            os.remove(final_filename)
+            bitrate = fit_bitrate(info.get('duration'))
+            final_filename, path = convert_audio(
+                src_path, base_path, info.get('acodec'), 'low', title, artist, cover, bitrate
+            )
+            quality = 'low'
+    finally:
+        if os.path.exists(src_path):
+            os.remove(src_path)
+    logger.info(f"Audio {video_id}: {path} ({info.get('acodec')})")
+
+    return final_filename, {
+        'title': title,
+        'artist': artist,
+        'duration': info.get('duration', 0),
+        'cover': cover,
+        'quality': quality,
+        'audio_path': path,
+    }
+
+# Скачивания в процессе: (video_id, quality) -> Task с треком AUDIO_CACHE.
+# Клики, пакеты и предзагрузка одного трека ждут одну задачу: иначе они
+# пишут в одни и те же файлы staging и удаляют их друг у друга
+INFLIGHT_FETCHES = {}
+
+async def run_fetch(video_id, quality, cancel=None, **run_kwargs):
+    """prepare_track в DOWNLOAD_POOL; готовый файл попадает в AUDIO_CACHE"""
+    staged_path, meta = await DOWNLOAD_POOL.run(prepare_track, video_id, quality, cancel, **run_kwargs)
+    AUDIO_PATH_STATS[meta.pop('audio_path')] += 1
+    tier = meta.pop('quality')
+    track = AUDIO_CACHE.put((video_id, tier), staged_path, meta, requested=quality)
+    # Запрошенное качество не влезло в лимит - remember_upload запишет это в TRACK_CACHE
+    return dict(track, requested=quality) if tier != quality else track
+
+async def fetch_track(video_id, quality, cancel=None, **run_kwargs):
+    """run_fetch с одной загрузкой на ключ: остальные вызовы к ней присоединяются.
+
+    Параметры очереди (run_kwargs) берутся у того, кто начал загрузку. Если
+    прервали чужую вытесняемую загрузку (предзагрузку), а этот вызов
+    не вытесняемый, загрузка начинается заново.
+    """
+    from yt_dlp.utils import DownloadCancelled
+    key = (video_id, quality)
+
+    def forget(task):
+        if INFLIGHT_FETCHES.get(key) is task:
+            del INFLIGHT_FETCHES[key]
+        # Исключение могут так и не забрать, если все ожидающие ушли
+        task.cancelled() or task.exception()
+
+    while True:
+        fetch = INFLIGHT_FETCHES.get(key)
+        owner = fetch is None
+        if owner:
+            fetch = asyncio.create_task(run_fetch(video_id, quality, cancel, **run_kwargs))
+            fetch.add_done_callback(forget)
+            INFLIGHT_FETCHES[key] = fetch
+        try:
+            # Отмена ожидающего не прерывает загрузку для остальных
+            return await asyncio.shield(fetch)
+        except DownloadCancelled:
+            if owner or cancel is not None:
+                raise
+            if INFLIGHT_FETCHES.get(key) is fetch:
+                del INFLIGHT_FETCHES[key]
+
+class DownloadFailed(Exception):
+    """Загрузка, которую ждали другие пользователи, не удалась"""
+
+# Загрузки в процессе: (video_id, quality) -> Future с записью TRACK_CACHE
+INFLIGHT_DOWNLOADS = {}
+
+def remember_upload(video_id, track, cache_data):
+    """Кладёт file_id в TRACK_CACHE под качеством файла.
+
+    Если запрошенное качество не влезло в лимит, запись дублируется и под ним:
+    pick_tier не отдаёт тир ниже запрошенного, и трек качался бы заново.
+    """
+    TRACK_CACHE[(video_id, track['quality'])] = cache_data
+    if track.get('requested'):
+        TRACK_CACHE[(video_id, track['requested'])] = cache_data
+
+async def send_cached_audio(context, chat_id, cache_data):
+    """Повторно отправляет уже загруженный в Telegram трек по file_id.
+
+    cache_data['kind'] - voice/document, если Telegram сохранил файл не как аудио
+    (только у ожидающих загрузку в INFLIGHT_DOWNLOADS, в TRACK_CACHE такого нет).
+    """
+    send = getattr(context.bot, f"send_{cache_data.get('kind', 'audio')}")
+    return await send(
+        chat_id,
+        cache_data['file_id'],
+        caption=f"🎵 <b>{cache_data['title']}</b>\n👤 {cache_data['artist']}",
+        parse_mode='HTML'
+    )
+
+def queue_reporter(query, stage):
+    """on_queued для планировщика: показывает позицию в очереди в статусном сообщении"""
+    async def report(position):
+        try:
+            await query.edit_message_text(
+                f'⏳ <b>Сервер занят</b> ({stage}), ты #{position} в очереди...', parse_mode='HTML'
+            )
+        except Exception:
+            pass
+    return report
+
+async def upload_track(context, chat_id, video_id, track, user_id=None, priority=PRIORITY_NORMAL, on_queued=None):
+    """Загружает скачанный трек в Telegram и кладёт его file_id в TRACK_CACHE"""
+    final_filename = track['path']
+    title = track['title']
+    artist = track['artist']
+
+    with METRICS.stage('upload_queue'):
+        await UPLOAD_SLOTS.acquire(user_id, priority, on_queued)
+    try:
+        size = os.path.getsize(final_filename)
+        await UPLOAD_BANDWIDTH.consume(size)
+        with METRICS.stage('upload'), open(final_filename, 'rb') as audio:
+            # Те же байты, что ушли в тег обложки
+            msg = await upload_bot(context).send_audio(
+                chat_id=chat_id,
+                audio=audio,
+                thumbnail=track['cover'],
+                title=title,
+                performer=artist,
+                duration=track['duration'],
+                caption=f'🎵 <b>{title}</b>\n👤 {artist}',
+                parse_mode='HTML'
+            )
+    finally:
+        UPLOAD_SLOTS.release()
+    METRICS.inc('uploaded_bytes_total', size)
+
+    # Ogg из AUDIO_MODE=native Telegram может сохранить как голосовое или документ
+    media = msg.audio or msg.voice or msg.document
+    if media is None:
+        raise DownloadFailed(f"Telegram did not return audio for {video_id}")
+
+    cache_data = {
+        'file_id': media.file_id,
+        'title': title,
+        'artist': artist
+    }
+    if msg.audio:
+        remember_upload(video_id, track, cache_data)
+    else:
+        # Файл уже в чате; по file_id его можно переслать только тем же методом
+        cache_data['kind'] = 'voice' if msg.voice else 'document'
+        logger.warning(f"Telegram stored {video_id} as {cache_data['kind']}, not caching")
+    return cache_data
+
+def spawn_job(context, coroutine, update=None):
+    """Долгая часть обработчика - отдельной задачей приложения.
+
+    Обработчик возвращается сразу после постановки в очередь: очередь
+    пользователя в ChatOrderedUpdateProcessor и слот CONCURRENT_UPDATES
+    не держатся до конца загрузки. Ошибки уходят в обработчики ошибок PTB.
+    """
+    return context.application.create_task(coroutine, update=update)
+
 async def download_and_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Проверяет лимит и запоминает качество, загрузка идёт в download_job"""
     query = update.callback_query
     
     data = query.data
@@ -346,143 +1980,277 @@ async def download_and_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = query.from_user.id
     video_id = data.replace('dl_', '')
-    video_url = f'https://www.youtube.com/watch?v={video_id}'
     
     # Проверка лимита
-    user_data = context.user_data
-    hour_key = f"downloads_{user_id}_{__import__('datetime').datetime.now().hour}"
-    hourly_count = user_data.get(hour_key, 0)
+    user = USERS.get(user_id)
     
-    if hourly_count >= 20:
+    if not user.can_download():
+        minutes = int(user.wait_time() // 60) + 1
         try:
-            await query.edit_message_text('⏳ Лимит: 20 треков в час. Подожди немного!')
+            await query.edit_message_text(
+                f'⏳ Лимит: {RATE_LIMIT_TRACKS} треков в час. Следующий трек через {minutes} мин.'
+            )
             return
         except:
             return
     
+    quality = user.quality
+
+    if query.message:
+        chat_id = query.message.chat_id
+        success_text = '✅ <b>Отправлено!</b>'
+    else:
+        chat_id = user_id
+        success_text = '📩 <b>Отправил трек тебе в ЛС!</b>'
+
+    spawn_job(context, download_job(query, context, user, video_id, quality, chat_id, success_text), update)
+
+@METRICS.timed('download_request')
+async def download_job(query, context, user, video_id, quality, chat_id, success_text):
+    user_id = user.user_id
+    # Трек уже есть в Telegram в подходящем качестве - обходимся без скачивания
+    cache_data = TRACK_CACHE.lookup(video_id, quality)
+    METRICS.inc('track_cache_requests_total', result='hit' if cache_data else 'miss')
+    
     try:
-        await query.edit_message_text('⬇️ <b>Скачиваю...</b>', parse_mode='HTML')
+        await query.edit_message_text(
+            '📤 <b>Отправляю...</b>' if cache_data else '⬇️ <b>Скачиваю...</b>', parse_mode='HTML'
+        )
     except: 
         pass
-    
-    quality = USER_SETTINGS.get(user_id, 'high')
-    filepath_tmpl = os.path.join(TEMP_DIR, f'{video_id}.%(ext)s')
-    
-    try:
-        # Не забываем про imageio_ffmpeg, если ты его добавил
-        import imageio_ffmpeg
-        ffmpeg_path = imageio_ffmpeg.get_ffmpeg_exe()
-        
-        # Обновляем опции, добавляем путь к ffmpeg
-        opts = get_ydl_opts(is_download=True, filepath=filepath_tmpl, quality=quality)
-        opts['ffmpeg_location'] = ffmpeg_path  # Явно указываем путь
-
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
-            
-            # --- ИСПРАВЛЕНИЕ ТУТ ---
-            # Мы жестко задаем имя файла, так как точно знаем, что конвертируем в m4a
-            final_filename = os.path.join(TEMP_DIR, f"{video_id}.m4a")
-            # -----------------------
-            
-            full_title = info.get('title', 'Unknown')
-            uploader = info.get('uploader', 'Unknown Artist')
-            duration = info.get('duration', 0)
-            thumb_url = info.get('thumbnail')
-            
-            # УМНЫЙ ПАРСИНГ
-            artist, title = parse_artist_title(full_title, uploader)
 
-        thumb_path = download_thumbnail(thumb_url, video_id) if thumb_url else None
-        
-        # Добавим лог, чтобы видеть, нашел ли бот файл
-        if os.path.exists(final_filename):
-            add_metadata_and_cover(final_filename, title, artist, thumb_path)
-            
-            if query.message:
-                chat_id = query.message.chat_id
-                success_text = '✅ <b>Отправлено!</b>'
-            else:
-                chat_id = user_id
-                success_text = '✅ <b>Отправлено в личку!</b>'
-                try:
-                    await query.edit_message_text('📩 <b>Отправил трек тебе в ЛС!</b>', parse_mode='HTML')
-                except: 
-                    pass
-
-            with open(final_filename, 'rb') as audio:
-                t_data = open(thumb_path, 'rb').read() if thumb_path else None
-                
-                msg = await context.bot.send_audio(
-                    chat_id=chat_id,
-                    audio=audio,
-                    thumbnail=t_data,
-                    title=title,
-                    performer=artist,
-                    duration=duration,
-                    caption=f'🎵 <b>{title}</b>\n👤 {artist}',
-                    parse_mode='HTML'
-                )
-                
-                if msg.audio:
-                    TRACK_CACHE[video_id] = {
-                        'file_id': msg.audio.file_id,
-                        'title': title,
-                        'artist': artist
-                    }
-                    save_cache(TRACK_CACHE)
-
-            # Статистика
-            user_data['downloads'] = user_data.get('downloads', 0) + 1
-            user_data[hour_key] = hourly_count + 1
+    key = (video_id, quality)
+    inflight = INFLIGHT_DOWNLOADS.get(key)
 
+    try:
+        if cache_data:
+            await send_cached_audio(context, chat_id, cache_data)
+        elif inflight:
+            # Этот трек уже качает кто-то другой - ждём его file_id
             try:
-                if query.message:
-                    await query.edit_message_text(success_text, parse_mode='HTML')
-            except: 
-                pass
-            
-            # Очистка
-            if os.path.exists(final_filename):
-                os.remove(final_filename)
-            if thumb_path and os.path.exists(thumb_path):
-                os.remove(thumb_path)
+                cache_data = await asyncio.shield(inflight)
+            except DownloadFailed:
+                await query.edit_message_text('❌ Ошибка загрузки. Попробуй другой трек.', parse_mode='HTML')
+                return
+            await send_cached_audio(context, chat_id, cache_data)
         else:
-            # Если файл не найден - сообщаем об ошибке
-            logger.error(f"File not found: {final_filename}")
-            await query.edit_message_text('❌ Ошибка: файл скачался, но потерялся.', parse_mode='HTML')
+            inflight = asyncio.get_running_loop().create_future()
+            # Исключение могут так и не забрать, если никто не ждал
+            inflight.add_done_callback(lambda f: f.cancelled() or f.exception())
+            INFLIGHT_DOWNLOADS[key] = inflight
+            try:
+                await download_and_upload(query, context, chat_id, user_id, video_id, quality, inflight)
+            finally:
+                INFLIGHT_DOWNLOADS.pop(key, None)
+                if not inflight.done():
+                    inflight.set_exception(DownloadFailed(video_id))
+            if inflight.exception():
+                return
+
+        # Статистика
+        user.downloads += 1
+        user.consume()
+        USERS.save(user)
+
+        try:
+            await query.edit_message_text(success_text, parse_mode='HTML')
+        except: 
+            pass
             
     except Exception as e:
         logger.error(f"Download Error: {e}\n{traceback.format_exc()}")
+        METRICS.inc('errors_total', stage='download_request', type=type(e).__name__)
         try:
             await query.edit_message_text('❌ Ошибка загрузки. Попробуй другой трек.', parse_mode='HTML')
         except: 
             pass
 
+async def download_and_upload(query, context, chat_id, user_id, video_id, quality, inflight):
+    """Скачивает трек, отправляет его в чат и публикует результат ожидающим в inflight"""
+    key = (video_id, quality)
+    try:
+        await PREFETCHER.wait(key)
+        # Файл мог остаться от прошлых загрузок или предзагрузки
+        track = AUDIO_CACHE.get(key)
+        if track is not None:
+            PREFETCHER.record_hit(key)
+            priority = PRIORITY_CACHED
+        else:
+            track = await fetch_track(
+                video_id, quality,
+                user_id=user_id, on_queued=queue_reporter(query, 'скачивание')
+            )
+            priority = PRIORITY_NORMAL
+
+        final_filename = track['path']
+        # Добавим лог, чтобы видеть, нашел ли бот файл
+        if not os.path.exists(final_filename):
+            # Если файл не найден - сообщаем об ошибке
+            logger.error(f"File not found: {final_filename}")
+            await query.edit_message_text('❌ Ошибка: файл скачался, но потерялся.', parse_mode='HTML')
+            return
+
+        inflight.set_result(await upload_track(
+            context, chat_id, video_id, track,
+            user_id=user_id, priority=priority, on_queued=queue_reporter(query, 'отправка')
+        ))
+    except PoolBusy:
+        await query.edit_message_text('⏳ Сервер перегружен, попробуй через минуту.')
+    except TrackTooLarge as e:
+        await query.edit_message_text(f'❌ Не могу отправить: {e}.')
+
+# === ПРЕДЗАГРУЗКА ===
+# Топ-N результатов /find заранее качаются на свободных воркерах в AUDIO_CACHE
+PREFETCH_TOP_N = int(os.getenv('PREFETCH_TOP_N', '0'))  # 0 - выключено
+
+class Prefetcher:
+    """Фоновая предзагрузка треков в AUDIO_CACHE.
+
+    Задачи идут в DOWNLOAD_POOL как вытесняемые: занимают только свободные
+    воркеры и прерываются, как только воркер нужен настоящему запросу.
+    """
+
+    # Сколько предзагруженных ключей помнить для подсчёта попаданий
+    MAX_TRACKED = 1000
+
+    def __init__(self, top_n):
+        self.top_n = top_n
+        self.prefetched = OrderedDict()  # (video_id, quality) -> None, ещё не востребованные
+        self.pending = {}                # (video_id, quality) -> asyncio.Task
+        self.stats = Counter()
+
+    @property
+    def hit_rate(self):
+        done = self.stats['completed']
+        return self.stats['hits'] / done if done else 0.0
+
+    def schedule(self, results, quality):
+        for r in results[:self.top_n]:
+            key = (r['id'], quality)
+            if key in self.prefetched or key in self.pending or key in INFLIGHT_DOWNLOADS or key in INFLIGHT_FETCHES:
+                continue
+            if TRACK_CACHE.lookup(r['id'], quality):
+                continue
+            self.pending[key] = asyncio.create_task(self._prefetch(key))
+
+    async def wait(self, key):
+        """Дожидается идущей предзагрузки этого трека, если она есть"""
+        task = self.pending.get(key)
+        if task:
+            await asyncio.shield(task)
+
+    def record_hit(self, key):
+        if key in self.prefetched:
+            del self.prefetched[key]
+            self.stats['hits'] += 1
+            logger.info(f"Prefetch hit {key}, hit rate {self.hit_rate:.0%} ({dict(self.stats)})")
+
+    async def _prefetch(self, key):
+        from yt_dlp.utils import DownloadCancelled
+        video_id, quality = key
+        if AUDIO_CACHE.get(key) is not None:
+            self.pending.pop(key, None)
+            return
+        cancel = DOWNLOAD_POOL.cancel_token(f'{video_id}_{quality}')
+        try:
+            await fetch_track(video_id, quality, cancel, preemptible=cancel)
+        except PoolBusy:
+            self.stats['skipped'] += 1
+            return
+        except DownloadCancelled:
+            self.stats['cancelled'] += 1
+            return
+        except Exception as e:
+            self.stats['failed'] += 1
+            logger.error(f"Prefetch error {key}: {e}")
+            return
+        finally:
+            self.pending.pop(key, None)
+            if isinstance(cancel, CancelToken):
+                cancel.discard()
+
+        self.stats['completed'] += 1
+        self.prefetched[key] = None
+        while len(self.prefetched) > self.MAX_TRACKED:
+            self.prefetched.popitem(last=False)
+
+PREFETCHER = Prefetcher(PREFETCH_TOP_N)
+
 # === INLINE РЕЖИМ ===
+INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE', '0.4'))
+INLINE_MIN_QUERY_LEN = int(os.getenv('INLINE_MIN_QUERY_LEN', '2'))
+# Первая страница маленькая, чтобы ответить быстрее; остальные - по прокрутке
+INLINE_FIRST_PAGE = int(os.getenv('INLINE_FIRST_PAGE', '5'))
+INLINE_PAGE_SIZE = int(os.getenv('INLINE_PAGE_SIZE', '10'))
+INLINE_MAX_RESULTS = int(os.getenv('INLINE_MAX_RESULTS', '50'))
+
+# user_id -> задача последнего inline-запроса пользователя
+INLINE_TASKS = {}
+
 async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.inline_query.query
-    if not query: 
+    if not query or len(normalize_query(query)) < INLINE_MIN_QUERY_LEN: 
         return
+
+    # Telegram присылает апдейт почти на каждый символ: новый запрос
+    # отменяет предыдущий, а поиск стартует только после паузы в наборе
+    user_id = update.inline_query.from_user.id
+    task = asyncio.current_task()
+    previous = INLINE_TASKS.get(user_id)
+    if previous and previous is not task:
+        previous.cancel()
+    INLINE_TASKS[user_id] = task
+
+    try:
+        # Следующие страницы запрашиваются прокруткой, а не набором текста
+        if not update.inline_query.offset:
+            await asyncio.sleep(INLINE_DEBOUNCE)
+        await answer_inline_query(update, context, query)
+    except asyncio.CancelledError:
+        # Запрос устарел - пользователь уже набрал следующий
+        pass
+    finally:
+        if INLINE_TASKS.get(user_id) is task:
+            del INLINE_TASKS[user_id]
+
+@METRICS.timed('inline_answer')
+async def answer_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    try:
+        offset = int(update.inline_query.offset or 0)
+    except ValueError:
+        offset = 0
+
+    user = USERS.get(update.inline_query.from_user.id)
+    if offset == 0:
+        user.searches += 1
+        USERS.save(user)
+        page_end = INLINE_FIRST_PAGE
+    else:
+        page_end = offset + INLINE_PAGE_SIZE
+    page_end = min(page_end, INLINE_MAX_RESULTS)
+    quality = user.quality
     
-    user_data = context.user_data
-    user_data['searches'] = user_data.get('searches', 0) + 1
-    
-    results = search_youtube(query, max_results=15)
+    try:
+        # Предыдущие страницы уже лежат в SEARCH_CACHE
+        results = await search_async(query, max_results=page_end, user_id=user.user_id)
+    except PoolBusy:
+        await update.inline_query.answer(
+            [], cache_time=1,
+            button=InlineQueryResultsButton(text='⏳ Сервер перегружен, попробуй через пару секунд', start_parameter='busy')
+        )
+        return
     articles = []
     
-    for r in results:
+    page = results[offset:page_end]
+    # Парсим названия всей страницы разом
+    for r, (artist, title) in zip(page, parse_many(page)):
         vid = r['id']
-        full_title = r.get('title', 'Unknown')
-        uploader = r.get('uploader', 'Unknown')
         duration = format_duration(r.get('duration'))
         
-        # Парсим название
-        artist, title = parse_artist_title(full_title, uploader)
         display_title = f"{artist} - {title}"
         
-        if vid in TRACK_CACHE:
-            cache_data = TRACK_CACHE[vid]
+        cache_data = TRACK_CACHE.lookup(vid, quality)
+        if cache_data:
             articles.append(InlineQueryResultCachedAudio(
                 id=vid,
                 audio_file_id=cache_data['file_id'],
@@ -503,7 +2271,11 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ]])
             ))
             
-    await update.inline_query.answer(articles, cache_time=5)
+    has_more = len(results) >= page_end and page_end < INLINE_MAX_RESULTS
+    # file_id в ответе зависят от качества пользователя - кэш Telegram только личный
+    await update.inline_query.answer(
+        articles, cache_time=5, is_personal=True, next_offset=str(page_end) if has_more else ''
+    )
 
 # === КОМАНДА FIND ===
 async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -514,27 +2286,323 @@ async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    user_data = context.user_data
-    user_data['searches'] = user_data.get('searches', 0) + 1
+    user = USERS.get(update.effective_user.id)
+    user.searches += 1
+    USERS.save(user)
     
     msg = await update.message.reply_text("🔎 Ищу...")
-    results = search_youtube(" ".join(context.args), max_results=5)
+
+    async def report_queue(position):
+        try:
+            await msg.edit_text(f"🔎 Ищу... (сервер занят, ты #{position} в очереди)")
+        except Exception:
+            pass
+
+    try:
+        results = await search_async(" ".join(context.args), max_results=5, on_queued=report_queue, user_id=user.user_id)
+    except PoolBusy:
+        await msg.edit_text("⏳ Сервер перегружен, попробуй через минуту.")
+        return
     
     if not results:
         await msg.edit_text("😔 Ничего не найдено. Попробуй изменить запрос.")
         return
 
     kb = []
-    for r in results:
-        artist, title = parse_artist_title(r.get('title', ''), r.get('uploader', ''))
+    for r, (artist, title) in zip(results, parse_many(results, default='')):
         duration = format_duration(r.get('duration'))
         display = f"🎵 {artist} - {title} ({duration})"
         kb.append([InlineKeyboardButton(display[:60], callback_data=f"dl_{r['id']}")])
     
+    kb.append([InlineKeyboardButton("☑️ Выбрать несколько", callback_data="multi")])
     kb.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel")])
     
     await msg.edit_text("🎯 <b>Результаты поиска:</b>", parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
 
+    if PREFETCH_TOP_N:
+        PREFETCHER.schedule(results, user.quality)
+
+# === ПЛЕЙЛИСТЫ И ПАКЕТНАЯ ЗАГРУЗКА ===
+# Плейлист или несколько результатов /find: треки из TRACK_CACHE не качаются,
+# остальные качаются параллельно, а отправляются по порядку, группами
+PLAYLIST_MAX_TRACKS = int(os.getenv('PLAYLIST_MAX_TRACKS', '50'))
+# Сколько треков одного пакета одновременно занимают DOWNLOAD_POOL
+PLAYLIST_PARALLEL = int(os.getenv('PLAYLIST_PARALLEL', str(DOWNLOAD_WORKERS)))
+PLAYLIST_MEDIA_GROUPS = os.getenv('PLAYLIST_MEDIA_GROUPS', '1') == '1'
+PLAYLIST_PROGRESS_INTERVAL = float(os.getenv('PLAYLIST_PROGRESS_INTERVAL', '2'))
+# Наибольшая пауза между попытками, пока очередь DOWNLOAD_POOL переполнена
+PLAYLIST_BUSY_BACKOFF = float(os.getenv('PLAYLIST_BUSY_BACKOFF', '30'))
+MEDIA_GROUP_SIZE = 10  # ограничение Telegram
+
+PLAYLIST_URL_RE = re.compile(r'https?://([\w-]+\.)?(youtube\.com|youtu\.be)/', re.IGNORECASE)
+
+# Отметки выбора в клавиатуре /find: состояние хранится в самих кнопках
+MARK_OFF = '⬜ '
+MARK_ON = '✅ '
+
+# Пакеты в работе: user_id -> Task; у пользователя один пакет за раз
+ACTIVE_BATCHES = {}
+STOP_BATCH_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton('⛔ Остановить', callback_data='stop_batch')]])
+
+def expand_playlist(url, limit=PLAYLIST_MAX_TRACKS):
+    """Название плейлиста и его треки без скачивания (extract_flat)"""
+    import yt_dlp
+    opts = get_ydl_opts(is_download=False)
+    opts['extract_flat'] = 'in_playlist'
+    opts['playlistend'] = limit
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    # Ссылка на одно видео - плейлист из одного трека
+    entries = info.get('entries') or [info]
+    tracks = [
+        {'id': e['id'], 'title': e.get('title'), 'duration': e.get('duration')}
+        for e in entries if e and e.get('id')
+    ]
+    return info.get('title') or 'Плейлист', tracks[:limit]
+
+class BatchProgress:
+    """Одно статусное сообщение на весь пакет, правится не чаще интервала"""
+
+    def __init__(self, message, title, total):
+        self.message = message
+        self.title = title
+        self.total = total
+        self.ready = 0
+        self.sent = 0
+        self.failed = 0
+        self.stopped = False
+        self._shown = None
+        self._updated_at = 0.0
+
+    def text(self, done=False):
+        head = f'📃 <b>{self.title}</b>\n'
+        if self.stopped:
+            text = head + f'⛔ Остановлено, отправлено {self.sent} из {self.total}'
+        elif done:
+            text = head + f'✅ Отправлено {self.sent} из {self.total}'
+        else:
+            text = head + f'⬇️ Готово {self.ready}/{self.total}, отправлено {self.sent}/{self.total}'
+        if self.failed:
+            text += f'\n❌ Не удалось: {self.failed}'
+        return text
+
+    async def update(self, done=False):
+        now = time.monotonic()
+        if not done and now - self._updated_at < PLAYLIST_PROGRESS_INTERVAL:
+            return
+        text = self.text(done)
+        if text == self._shown:
+            return
+        self._shown = text
+        self._updated_at = now
+        try:
+            await self.message.edit_text(
+                text, parse_mode='HTML', reply_markup=None if done else STOP_BATCH_KEYBOARD
+            )
+        except Exception:
+            pass
+
+async def send_media_group(context, chat_id, items, user_id):
+    """Отправляет 2-10 треков одним альбомом; новые file_id - в TRACK_CACHE"""
+    files = [data for _, kind, data in items if kind == 'file']
+    await UPLOAD_SLOTS.acquire(user_id, PRIORITY_NORMAL)
+    try:
+        size = sum(os.path.getsize(track['path']) for track in files)
+        await UPLOAD_BANDWIDTH.consume(size)
+        with contextlib.ExitStack() as stack:
+            media = []
+            for _, kind, data in items:
+                if kind == 'cached':
+                    media.append(InputMediaAudio(data['file_id']))
+                else:
+                    media.append(InputMediaAudio(
+                        stack.enter_context(open(data['path'], 'rb')),
+                        title=data['title'],
+                        performer=data['artist'],
+                        duration=data['duration'],
+                        thumbnail=data['cover'],
+                    ))
+            with METRICS.stage('upload'):
+                messages = await upload_bot(context).send_media_group(chat_id, media)
+    finally:
+        UPLOAD_SLOTS.release()
+    METRICS.inc('uploaded_bytes_total', size)
+
+    for (video_id, kind, data), msg in zip(items, messages):
+        if kind == 'file' and msg.audio:
+            remember_upload(video_id, data, {
+                'file_id': msg.audio.file_id,
+                'title': data['title'],
+                'artist': data['artist'],
+            })
+
+async def deliver(context, chat_id, items, user_id):
+    """Отправляет готовые треки пакета в исходном порядке"""
+    if len(items) == 1:
+        video_id, kind, data = items[0]
+        if kind == 'cached':
+            await send_cached_audio(context, chat_id, data)
+        else:
+            await upload_track(context, chat_id, video_id, data, user_id=user_id)
+    else:
+        await send_media_group(context, chat_id, items, user_id)
+
+async def fetch_when_free(video_id, quality, user_id):
+    """fetch_track для пакетов: пока очередь DOWNLOAD_POOL переполнена,
+    ждёт с нарастающей паузой, а не теряет трек"""
+    delay = 1.0
+    while True:
+        try:
+            return await fetch_track(video_id, quality, user_id=user_id)
+        except PoolBusy:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, PLAYLIST_BUSY_BACKOFF)
+
+async def run_batch(context, chat_id, user, title, entries, message):
+    """Пакет пользователя через send_batch: один за раз, кнопка stop_batch его останавливает"""
+    if user.user_id in ACTIVE_BATCHES:
+        await message.edit_text('⏳ Уже качаю твой пакет - дождись его или останови.')
+        return
+    ACTIVE_BATCHES[user.user_id] = asyncio.current_task()
+    try:
+        await send_batch(context, chat_id, user, title, entries, message)
+    finally:
+        ACTIVE_BATCHES.pop(user.user_id, None)
+
+async def send_batch(context, chat_id, user, title, entries, message):
+    """Скачивает пакет треков и отправляет их по порядку.
+
+    Прогресс - в одном сообщении message. Лимит пользователя урезает пакет.
+    """
+    # Повторы в плейлисте качать и отправлять незачем
+    entries = list({e['id']: e for e in entries}.values())
+    allowed = user.available()
+    if not allowed:
+        minutes = int(user.wait_time() // 60) + 1
+        await message.edit_text(f'⏳ Лимит: {RATE_LIMIT_TRACKS} треков в час. Следующий трек через {minutes} мин.')
+        return
+    if allowed < len(entries):
+        title += f' (лимит: первые {allowed})'
+        entries = entries[:allowed]
+
+    quality = user.quality
+    progress = BatchProgress(message, title, len(entries))
+    parallel = asyncio.Semaphore(PLAYLIST_PARALLEL)
+    await progress.update()
+
+    async def resolve(video_id):
+        """file_id из TRACK_CACHE или готовый файл из AUDIO_CACHE/загрузки"""
+        key = (video_id, quality)
+        try:
+            cached = TRACK_CACHE.lookup(video_id, quality)
+            if cached is None and key in INFLIGHT_DOWNLOADS:
+                with contextlib.suppress(DownloadFailed):
+                    cached = await asyncio.shield(INFLIGHT_DOWNLOADS[key])
+            if cached:
+                result = (video_id, 'cached', cached)
+            else:
+                await PREFETCHER.wait(key)
+                track = AUDIO_CACHE.get(key)
+                if track is not None:
+                    PREFETCHER.record_hit(key)
+                else:
+                    async with parallel:
+                        track = await fetch_when_free(video_id, quality, user.user_id)
+                result = (video_id, 'file', track)
+        except Exception as e:
+            logger.error(f"Batch track {video_id} failed: {e}")
+            METRICS.inc('errors_total', stage='batch_track', type=type(e).__name__)
+            progress.failed += 1
+            return None
+        progress.ready += 1
+        await progress.update()
+        return result
+
+    tasks = [asyncio.create_task(resolve(e['id'])) for e in entries]
+    group = MEDIA_GROUP_SIZE if PLAYLIST_MEDIA_GROUPS else 1
+    try:
+        for start in range(0, len(tasks), group):
+            # Следующая группа уходит, как только готовы все её треки
+            items = [item for item in [await task for task in tasks[start:start + group]] if item]
+            if not items:
+                continue
+            try:
+                await deliver(context, chat_id, items, user.user_id)
+            except Exception as e:
+                logger.error(f"Batch delivery error: {e}\n{traceback.format_exc()}")
+                METRICS.inc('errors_total', stage='batch_delivery', type=type(e).__name__)
+                progress.failed += len(items)
+                continue
+            progress.sent += len(items)
+            for _ in items:
+                user.consume()
+            user.downloads += len(items)
+            USERS.save(user)
+            await progress.update()
+    except asyncio.CancelledError:
+        progress.stopped = True
+        await progress.update(done=True)
+        raise
+    finally:
+        for task in tasks:
+            task.cancel()
+    await progress.update(done=True)
+
+async def playlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or not PLAYLIST_URL_RE.match(context.args[0]):
+        await update.message.reply_html(
+            '❓ <b>Использование:</b>\n/playlist ссылка на плейлист YouTube\n\n'
+            '<b>Пример:</b>\n<code>/playlist https://www.youtube.com/playlist?list=...</code>'
+        )
+        return
+
+    user = USERS.get(update.effective_user.id)
+    msg = await update.message.reply_text('📃 Открываю плейлист...')
+    spawn_job(context, playlist_job(context, update.effective_chat.id, user, context.args[0], msg), update)
+
+async def playlist_job(context, chat_id, user, url, msg):
+    """Открывает плейлист и качает его пакетом; запускается через spawn_job"""
+    try:
+        title, entries = await SEARCH_POOL.run(expand_playlist, url, user_id=user.user_id)
+    except PoolBusy:
+        await msg.edit_text('⏳ Сервер перегружен, попробуй через минуту.')
+        return
+    except Exception as e:
+        logger.error(f"Playlist error: {e}")
+        await msg.edit_text('❌ Не удалось открыть плейлист.')
+        return
+
+    if not entries:
+        await msg.edit_text('😔 В плейлисте нет треков.')
+        return
+    await run_batch(context, chat_id, user, title, entries, msg)
+
+def selection_keyboard(markup, toggle=None):
+    """Клавиатура выбора из результатов /find; toggle - video_id, чью отметку сменить"""
+    rows = []
+    for row in markup.inline_keyboard:
+        button = row[0]
+        data = button.callback_data or ''
+        if data.startswith('dl_'):
+            text = MARK_OFF + button.text.removeprefix('🎵 ')
+            rows.append([InlineKeyboardButton(text, callback_data=f'sel_{data[3:]}')])
+        elif data.startswith('sel_'):
+            text = button.text
+            if data[4:] == toggle:
+                mark = MARK_OFF if text.startswith(MARK_ON) else MARK_ON
+                text = mark + text.removeprefix(MARK_ON).removeprefix(MARK_OFF)
+            rows.append([InlineKeyboardButton(text, callback_data=data)])
+    rows.append([InlineKeyboardButton('⬇️ Скачать выбранные', callback_data='batch')])
+    rows.append([InlineKeyboardButton('❌ Отмена', callback_data='cancel')])
+    return InlineKeyboardMarkup(rows)
+
+def selected_tracks(markup):
+    return [
+        {'id': row[0].callback_data[4:]}
+        for row in markup.inline_keyboard
+        if (row[0].callback_data or '').startswith('sel_') and row[0].text.startswith(MARK_ON)
+    ]
+
 # === CALLBACK ОБРАБОТЧИКИ ===
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -553,9 +2621,28 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await help_command(update, context)
     elif data.startswith('quality_'):
         quality = data.replace('quality_', '')
-        USER_SETTINGS[query.from_user.id] = quality
+        user = USERS.get(query.from_user.id)
+        user.quality = quality
+        USERS.save(user)
         await query.answer(f"✅ Качество изменено на {quality.upper()}!", show_alert=True)
         await settings_command(update, context)
+    elif data == 'multi' or data.startswith('sel_'):
+        toggle = data[4:] if data.startswith('sel_') else None
+        try:
+            await query.edit_message_reply_markup(selection_keyboard(query.message.reply_markup, toggle))
+        except Exception:
+            pass
+    elif data == 'batch':
+        entries = selected_tracks(query.message.reply_markup)
+        if entries:
+            user = USERS.get(query.from_user.id)
+            spawn_job(context, run_batch(
+                context, query.message.chat_id, user, 'Выбранные треки', entries, query.message
+            ), update)
+    elif data == 'stop_batch':
+        task = ACTIVE_BATCHES.get(query.from_user.id)
+        if task:
+            task.cancel()
     elif data == 'back_start':
         await start(update, context)
     elif data == 'cancel':
@@ -568,31 +2655,224 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def new_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for m in update.message.new_chat_members:
         if m.id == context.bot.id:
-            bot_username = (await context.bot.get_me()).username
+            bot_username = context.bot.username
             await update.message.reply_html(
                 f'👋 <b>Привет! Я музыкальный бот!</b>\n\n'
                 f'Используй /find или @{bot_username} для поиска музыки\n'
                 f'Команды: /help'
             )
 
-def main():
-    if not BOT_TOKEN:
-        print("❌ BOT_TOKEN не установлен!")
+# === ЗАПУСК ===
+RUN_MODE = os.getenv('RUN_MODE', 'polling')  # polling | webhook
+# Сколько апдейтов обрабатывается одновременно; 0 - строго по одному
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '32'))
+# Нажатия кнопок одного пользователя в чате обрабатываются в порядке поступления
+PER_CHAT_ORDER = os.getenv('PER_CHAT_ORDER', '1') == '1'
+# 0 - после перезапуска обработать накопившиеся апдейты, а не выбросить их
+DROP_PENDING_UPDATES = os.getenv('DROP_PENDING_UPDATES', '1') == '1'
+
+# Webhook: WEBHOOK_URL - публичный адрес (без пути), который Telegram будет вызывать.
+# С WEBHOOK_CERT/WEBHOOK_KEY бот сам поднимает TLS (подходит самоподписанный
+# сертификат), без них слушает обычный HTTP за reverse proxy
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') or None
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT')
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY')
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Апдейты обрабатываются параллельно, нажатия кнопок одного пользователя
+    в чате - по очереди.
+
+    Так смена качества не обгоняет нажатую до неё загрузку, а отметки в
+    клавиатуре выбора не теряются. Обработчики кнопок быстрые: загрузки и
+    пакеты уходят в spawn_job, и очередь освобождается, как только работа
+    поставлена. Команды и inline-запросы не упорядочены.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._queues = {}  # (chat_id, user_id) -> [asyncio.Lock, сколько апдейтов его ждут]
+
+    @staticmethod
+    def order_key(update):
+        if not isinstance(update, Update) or update.callback_query is None:
+            return None
+        chat = update.effective_chat
+        return (chat and chat.id, update.callback_query.from_user.id)
+
+    async def do_process_update(self, update, coroutine):
+        key = self.order_key(update)
+        if key is None:
+            await coroutine
+            return
+        entry = self._queues.get(key)
+        if entry is None:
+            entry = self._queues[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._queues[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def update_processing():
+    """Значение для ApplicationBuilder.concurrent_updates"""
+    if CONCURRENT_UPDATES <= 1:
+        return False
+    if PER_CHAT_ORDER:
+        return ChatOrderedUpdateProcessor(CONCURRENT_UPDATES)
+    return CONCURRENT_UPDATES
+
+def warm_up():
+    """Подгружает тяжёлые модули и ffmpeg, пока бот уже принимает апдейты"""
+    started = time.perf_counter()
+    try:
+        import yt_dlp  # noqa: F401
+        import mutagen.mp4  # noqa: F401
+        from PIL import Image  # noqa: F401
+        ffmpeg_exe()
+    except Exception as e:
+        logger.error(f"Warm-up error: {e}")
         return
-        
-    app = Application.builder().token(BOT_TOKEN).build()
-    
+    logger.info(f"Warm-up done in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+# === HTTP-КЛИЕНТЫ TELEGRAM ===
+# Короткие вызовы API и долгие загрузки файлов идут через разные пулы:
+# отправка аудио не занимает соединения, нужные для ответов и правок
+# Пул коротких вызовов - как у ApplicationBuilder по умолчанию: его делят
+# CONCURRENT_UPDATES обработчиков, фоновые задачи и правки позиций в очередях
+TG_POOL_SIZE = int(os.getenv('TG_POOL_SIZE', '256'))
+TG_TIMEOUT = float(os.getenv('TG_TIMEOUT', '10'))
+TG_UPLOAD_TIMEOUT = float(os.getenv('TG_UPLOAD_TIMEOUT', '120'))
+# Общий лимит запросов в секунду и сообщений в минуту на группу (0 - без лимита);
+# на 429 RetryAfter запрос повторяется до TG_MAX_RETRIES раз
+TG_OVERALL_RATE = float(os.getenv('TG_OVERALL_RATE', '30'))
+TG_GROUP_RATE = float(os.getenv('TG_GROUP_RATE', '0'))
+TG_MAX_RETRIES = int(os.getenv('TG_MAX_RETRIES', '3'))
+# '2' - мультиплексирование запросов в одном соединении (нужен h2)
+TG_HTTP_VERSION = os.getenv('TG_HTTP_VERSION') or ('2' if http2_available() else '1.1')
+
+def telegram_request(pool_size, timeout):
+    """HTTPXRequest с keep-alive пулом на pool_size соединений"""
+    return HTTPXRequest(
+        connection_pool_size=pool_size,
+        read_timeout=timeout,
+        write_timeout=timeout,
+        media_write_timeout=timeout,
+        connect_timeout=5,
+        pool_timeout=timeout,
+        http_version=TG_HTTP_VERSION,
+    )
+
+def rate_limiter():
+    """AIORateLimiter, если установлен aiolimiter (экстра rate-limiter)"""
+    try:
+        return AIORateLimiter(
+            overall_max_rate=TG_OVERALL_RATE,
+            group_max_rate=TG_GROUP_RATE,
+            max_retries=TG_MAX_RETRIES,
+        )
+    except RuntimeError as e:
+        logger.warning(f"Rate limiter disabled: {e}")
+        return None
+
+def upload_bot(context):
+    """Бот с отдельным пулом для загрузки файлов"""
+    return context.bot_data.get('upload_bot') or context.bot
+
+def build_application(token, base_url=None, base_file_url=None):
+    """Application с настроенными пулами; base_url - для тестового сервера API"""
+    limiter = rate_limiter()
+    urls = {}
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(telegram_request(TG_POOL_SIZE, TG_TIMEOUT))
+        .concurrent_updates(update_processing())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+        urls['base_url'] = base_url
+    if base_file_url:
+        builder = builder.base_file_url(base_file_url)
+        urls['base_file_url'] = base_file_url
+    if limiter:
+        builder = builder.rate_limiter(limiter)
+    app = builder.build()
+    app.bot_data['upload_bot'] = ExtBot(
+        token,
+        request=telegram_request(MAX_UPLOADS, TG_UPLOAD_TIMEOUT),
+        rate_limiter=limiter,
+        **urls,
+    )
+    return app
+
+async def on_startup(app):
+    await app.bot_data['upload_bot'].initialize()
+    logger.info(f"Ready in {(time.perf_counter() - BOOT_STARTED) * 1000:.0f} ms as @{app.bot.username}")
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+async def on_shutdown(app):
+    await app.bot_data['upload_bot'].shutdown()
+
+MODULE_LOADED = time.perf_counter()
+
+def register_handlers(app):
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
+    # Обработчики блокирующие: параллельность и порядок задаёт update_processing()
     app.add_handler(CommandHandler("find", find_command))
+    app.add_handler(CommandHandler("playlist", playlist_command))
     app.add_handler(CommandHandler("settings", settings_command))
     app.add_handler(CommandHandler("stats", stats_command))
     app.add_handler(InlineQueryHandler(inline_query))
     app.add_handler(CallbackQueryHandler(button_callback))
     app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, new_chat_member))
+
+def main():
+    if not BOT_TOKEN:
+        print("❌ BOT_TOKEN не установлен!")
+        return
+    if RUN_MODE == 'webhook' and not WEBHOOK_URL:
+        print("❌ Для RUN_MODE=webhook нужен WEBHOOK_URL!")
+        return
+
+    logger.info(f"Module loaded in {(MODULE_LOADED - BOOT_STARTED) * 1000:.0f} ms")
+    app = build_application(BOT_TOKEN)
+    
+    register_handlers(app)
     
-    print("✅ Бот запущен!")
-    app.run_polling(drop_pending_updates=True)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+
+    print(f"✅ Бот запущен! ({RUN_MODE})")
+    if RUN_MODE == 'webhook':
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            cert=WEBHOOK_CERT,
+            key=WEBHOOK_KEY,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+        )
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=DROP_PENDING_UPDATES)
 
 if __name__ == '__main__':
     main()
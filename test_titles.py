@@ -0,0 +1,100 @@
+"""Корпус названий: фиксирует вывод parse_artist_title.
+
+Ожидаемые пары взяты из исходной реализации на регулярных выражениях,
+до таблицы TITLE_RULES. Запуск: python -m pytest -q test_titles.py
+"""
+import pytest
+
+import titles
+
+# (название, канал, исполнитель, трек)
+CORPUS = [
+    ('Rick Astley - Never Gonna Give You Up (Official Music Video)', 'Rick Astley', 'Rick Astley', 'Never Gonna Give You Up'),
+    ('Daft Punk - Get Lucky (Official Audio) ft. Pharrell Williams, Nile Rodgers', 'Daft Punk', 'Daft Punk', 'Get Lucky ft. Pharrell Williams, Nile Rodgers'),
+    ('Queen – Bohemian Rhapsody [Official Video Remastered]', 'Queen Official', 'Queen', 'Bohemian Rhapsody'),
+    ('Imagine Dragons — Believer | Lyrics', 'Lyrics Hub', 'Imagine Dragons', 'Believer'),
+    ('Blinding Lights', 'The Weeknd - Topic', 'The Weeknd', 'Blinding Lights'),
+    ('Shape of You', 'Ed Sheeran Topic', 'Ed Sheeran', 'Shape of You'),
+    ('Coldplay - Yellow (Lyrics)', 'Coldplay', 'Coldplay', 'Yellow'),
+    ('Nirvana - Smells Like Teen Spirit HD', 'NirvanaVEVO', 'Nirvana', 'Smells Like Teen Spirit HD'),
+    ('Linkin Park - Numb [4K]', 'Linkin Park', 'Linkin Park', 'Numb'),
+    ('Eminem - Lose Yourself - Official Music Video', 'EminemVEVO', 'Eminem', 'Lose Yourself'),
+    ('Adele - Hello | Official Music Video 2015', 'Adele', 'Adele', 'Hello'),
+    ('Metallica - Nothing Else Matters (1991)', 'Metallica', 'Metallica', 'Nothing Else Matters'),
+    ('Dua Lipa - Levitating [2020]', 'Dua Lipa', 'Dua Lipa', 'Levitating'),
+    ('BTS (방탄소년단) - Dynamite Official MV', 'HYBE LABELS', 'BTS (방탄소년단)', 'Dynamite Official MV'),
+    ('Sia - Chandelier {Official Video}', 'SiaVEVO', 'Sia', 'Chandelier'),
+    ('  Muse  -  Uprising   (Audio)  ', 'Muse', 'Muse', 'Uprising'),
+    ('Drake - Hotline Bling - Audio', 'Drake', 'Drake', 'Hotline Bling'),
+    ('AC/DC - Back In Black (Official Video)', 'AC/DC', 'AC/DC', 'Back In Black'),
+    ("Guns N' Roses - Sweet Child O' Mine (Official Music Video)", 'GunsNRosesVEVO', "Guns N' Roses", "Sweet Child O' Mine"),
+    ('Moby-Porcelain', 'Moby', 'Moby', 'Moby-Porcelain'),
+    ('Porcelain', 'Moby - Topic', 'Moby', 'Porcelain'),
+    ('(Official Video)', 'Someone', 'Someone', 'Unknown Track'),
+    ('', 'Someone', 'Someone', 'Unknown Track'),
+    ('2019', 'Year Channel', 'Year Channel', 'Unknown Track'),
+    ('Marshmello - Alone [Monstercat Release]', 'Monstercat', 'Marshmello', 'Alone [Monstercat Release]'),
+    ('Kanye West - Stronger (Music Video) (Explicit)', 'Kanye West', 'Kanye West', 'Stronger (Explicit)'),
+    ('Artist - Topic - Song', 'Uploader', 'Artist', 'Topic - Song'),
+    ('Calvin Harris - Summer [HD] [Lyric]', 'Calvin Harris', 'Calvin Harris', 'Summer'),
+    ('Tones and I – Dance Monkey (Lyrics)', 'Tones and I', 'Tones and I', 'Dance Monkey'),
+    ('Кино - Группа крови', 'Кино', 'Кино', 'Группа крови'),
+    ('Баста - Сансара (Премьера клипа, 2017)', 'Баста', 'Баста', 'Сансара'),
+    ('Zivert - Life [Премьера 2019]', 'Zivert', 'Zivert', 'Life'),
+    ('Мот - Капкан (Клип)', 'Мот', 'Мот', 'Капкан'),
+    ('Monetochka — Каждый раз (Official Video)', 'Монеточка', 'Monetochka', 'Каждый раз'),
+    ('ЛСП — Монетка | Official Audio', 'ЛСП', 'ЛСП', 'Монетка'),
+    ('Король и Шут - Лесник (Official Audio) 2001', 'Король и Шут - Topic', 'Король и Шут', 'Лесник'),
+    ('Звезда по имени Солнце', 'Кино - Topic', 'Кино', 'Звезда по имени Солнце'),
+    ('Земфира — Хочешь? (Клип) [HD]', 'Земфира', 'Земфира', 'Хочешь?'),
+    ('Скриптонит - Поворот (Премьера трека)', 'Скриптонит', 'Скриптонит', 'Поворот'),
+    ('Mark Ronson - Uptown Funk ft. Bruno Mars', 'Mark Ronson', 'Mark Ronson', 'Uptown Funk ft. Bruno Mars'),
+    ('Post Malone - Sunflower (feat. Swae Lee) [Official Audio]', 'Post Malone', 'Post Malone', 'Sunflower (feat. Swae Lee)'),
+    ('Rihanna - Umbrella (Feat. Jay-Z)', 'Rihanna', 'Rihanna', 'Umbrella (Feat. Jay-Z)'),
+    ('Stay ft. Justin Bieber', 'The Kid LAROI - Topic', 'The Kid LAROI', 'Stay ft. Justin Bieber'),
+    ('Баста - Выпускной ft. Тати', 'Баста', 'Баста', 'Выпускной ft. Тати'),
+    ('Feat. Nobody', 'Someone', 'Someone', 'Feat. Nobody'),
+]
+
+# Те же названия с TITLE_EXTRACT_FEAT=1; остальные записи корпуса не меняются
+FEAT_CASES = [
+    ('Daft Punk - Get Lucky (Official Audio) ft. Pharrell Williams, Nile Rodgers', 'Daft Punk', 'Daft Punk feat. Pharrell Williams, Nile Rodgers', 'Get Lucky'),
+    ('Mark Ronson - Uptown Funk ft. Bruno Mars', 'Mark Ronson', 'Mark Ronson feat. Bruno Mars', 'Uptown Funk'),
+    ('Post Malone - Sunflower (feat. Swae Lee) [Official Audio]', 'Post Malone', 'Post Malone feat. Swae Lee', 'Sunflower'),
+    ('Rihanna - Umbrella (Feat. Jay-Z)', 'Rihanna', 'Rihanna feat. Jay-Z', 'Umbrella'),
+    ('Stay ft. Justin Bieber', 'The Kid LAROI - Topic', 'The Kid LAROI feat. Justin Bieber', 'Stay'),
+    ('Баста - Выпускной ft. Тати', 'Баста', 'Баста feat. Тати', 'Выпускной'),
+]
+
+
+@pytest.fixture
+def extract_feat():
+    titles.configure_title_rules(extract_feat=True)
+    yield
+    titles.configure_title_rules(extract_feat=False)
+
+
+@pytest.mark.parametrize('full_title, uploader, artist, title', CORPUS)
+def test_parse_artist_title(full_title, uploader, artist, title):
+    assert titles.parse_artist_title(full_title, uploader) == (artist, title)
+
+
+def test_parse_many_matches_single():
+    results = [{'title': t, 'uploader': u} for t, u, _, _ in CORPUS]
+    assert titles.parse_many(results) == [(a, t) for _, _, a, t in CORPUS]
+
+
+def test_parse_many_defaults():
+    assert titles.parse_many([{}]) == [('Unknown', 'Unknown')]
+
+
+@pytest.mark.parametrize('full_title, uploader, artist, title', FEAT_CASES)
+def test_extract_feat(extract_feat, full_title, uploader, artist, title):
+    assert titles.parse_artist_title(full_title, uploader) == (artist, title)
+
+
+def test_extract_feat_keeps_other_titles(extract_feat):
+    changed = {(t, u) for t, u, _, _ in FEAT_CASES}
+    for full_title, uploader, artist, title in CORPUS:
+        if (full_title, uploader) not in changed:
+            assert titles.parse_artist_title(full_title, uploader) == (artist, title)
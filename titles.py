@@ -0,0 +1,115 @@
+"""Умный парсинг названий: исполнитель и трек из заголовка YouTube.
+
+Чистые функции без побочных эффектов при импорте - их можно проверять
+отдельно от bot.py (test_titles.py).
+"""
+import functools
+import os
+import re
+
+# Таблица правил: из неё один раз собираются скомпилированные выражения
+TITLE_RULES = {
+    # Хвосты после | или -, вместе с которыми отрезается всё до конца строки
+    'junk_suffixes': [
+        r'Official\s*(Music\s*)?(Video|Audio|Lyric Video)', r'Lyrics?', r'HD', r'4K',
+        r'Music\s*Video', r'Audio', r'MV',
+    ],
+    # Слова, с которых начинаются мусорные скобки: (Official...), [Премьера ...]
+    'junk_bracket_words': [
+        r'Official', r'Audio', r'Video', r'Lyric', r'Music', r'HD', r'4K', r'MV', r'Премьера', r'Клип',
+    ] + [re.escape(w.strip()) for w in os.getenv('TITLE_EXTRA_JUNK', '').split(',') if w.strip()],
+    # Разделители "Исполнитель - Название"
+    'separators': [' - ', ' – ', ' — '],
+    # feat./ft. из названия переносится к исполнителю
+    'extract_feat': os.getenv('TITLE_EXTRACT_FEAT', '0') == '1',
+}
+
+def _compile_title_rules(rules):
+    return {
+        'junk_suffix': re.compile(
+            r'\s*[\|\-]\s*(' + '|'.join(rules['junk_suffixes']) + r').*$', re.IGNORECASE
+        ),
+        'junk_bracket': re.compile(
+            r'\s*[\(\[\{]\s*(' + '|'.join(rules['junk_bracket_words']) + r').*?[\)\]\}]', re.IGNORECASE
+        ),
+        'year': re.compile(r'\s*[\(\[\{]?\s*(19|20)\d{2}\s*[\)\]\}]?\s*$'),
+        'spaces': re.compile(r'\s+'),
+        'separator': re.compile(r'\s*[-–—]\s*'),
+        'topic': re.compile(r'\s*-\s*Topic\s*$', re.IGNORECASE),
+        'feat': re.compile(r'\s*[\(\[]?\s*\b(?:feat|ft)\.?\s+([^\)\]]+?)\s*[\)\]]?\s*$', re.IGNORECASE),
+    }
+
+_TITLE_PATTERNS = _compile_title_rules(TITLE_RULES)
+
+def configure_title_rules(**overrides):
+    """Меняет правила парсинга на лету и сбрасывает кэш результатов"""
+    global _TITLE_PATTERNS
+    TITLE_RULES.update(overrides)
+    _TITLE_PATTERNS = _compile_title_rules(TITLE_RULES)
+    parse_artist_title.cache_clear()
+
+def clean_title(title):
+    """Убирает весь мусор из названия"""
+    if not title:
+        return "Unknown Track"
+    p = _TITLE_PATTERNS
+    
+    # Убираем всё после | или - если там есть "Official", "Audio", "Video" и т.д.
+    title = p['junk_suffix'].sub('', title)
+    
+    # Убираем (Official...), [Official...], и т.д.
+    title = p['junk_bracket'].sub('', title)
+    
+    # Убираем годы в конце (2023), [2024] и т.д.
+    title = p['year'].sub('', title)
+    
+    # Убираем лишние пробелы
+    title = p['spaces'].sub(' ', title).strip()
+    
+    return title if title else "Unknown Track"
+
+def _strip_topic(name):
+    """Убирает "Topic" из авто-каналов YouTube Music"""
+    return _TITLE_PATTERNS['topic'].sub('', name)
+
+def _extract_feat(artist, title):
+    match = _TITLE_PATTERNS['feat'].search(title)
+    if not match or match.start() == 0:
+        return artist, title
+    return f"{artist} feat. {match.group(1)}", title[:match.start()].strip()
+
+@functools.lru_cache(maxsize=4096)
+def parse_artist_title(full_title, uploader):
+    """Парсит исполнителя и название из заголовка"""
+    # Очищаем от мусора
+    full_title = clean_title(full_title)
+    
+    # Типичные форматы: "Artist - Title" или "Artist — Title"
+    if any(sep in full_title for sep in TITLE_RULES['separators']):
+        parts = _TITLE_PATTERNS['separator'].split(full_title, maxsplit=1)
+        if len(parts) == 2:
+            artist = parts[0].strip()
+            title = parts[1].strip()
+            
+            # Убираем "Topic" из исполнителя
+            artist = _strip_topic(artist)
+            artist = artist.replace(' Topic', '').strip()
+            
+            if TITLE_RULES['extract_feat']:
+                return _extract_feat(artist, title)
+            return artist, title
+    
+    # Если нет разделителя, используем uploader как артиста
+    uploader_clean = uploader.replace(' - Topic', '').replace(' Topic', '').strip()
+    uploader_clean = _strip_topic(uploader_clean)
+    
+    if TITLE_RULES['extract_feat']:
+        return _extract_feat(uploader_clean, full_title)
+    return uploader_clean, full_title
+
+def parse_many(results, default='Unknown'):
+    """Пакетный парсинг результатов поиска: [(artist, title), ...]"""
+    return [
+        parse_artist_title(r.get('title', default), r.get('uploader', default))
+        for r in results
+    ]